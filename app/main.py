@@ -1,25 +1,44 @@
 from fastapi import FastAPI, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
 import shutil
 import zipfile
-import json
-from typing import Optional
 import os
-from app.src.JBGAnnualReportAnalysis import JBGAnnualReportAnalyzer
-from app.src.JBGAnnualReportExceptions import FileTypeException, EmptyOutputException
-from app.src.JBGJSONConverter import JsonConverter
+from contextlib import asynccontextmanager
+from app.src.JBGAnnualReportExceptions import FileTypeException
+from app.src.JBGJobStore import JobStore
+from app.src.JBGJobQueue import JobQueue
+from app.src.JBGWorkspaces import WorkspaceManager
 from app.src.masking.JBGPDFMasking import PDFMasker
-from openai import OpenAI
+from app.src.masking.JBGNERRegistry import NERRegistry
 import logging
 from datetime import datetime
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARM_NER_MODEL:
+        NERRegistry.warm()
+    job_queue.start()
+    yield
+    job_queue.stop()
+    masker.close()
+
+app = FastAPI(lifespan=lifespan)
 BASE_DIR = Path(__file__).resolve().parent
-UPLOAD_DIR = BASE_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+WORKSPACE_DIR = BASE_DIR / "workspaces"
+WORKSPACE_TTL_SECONDS = int(os.environ.get("JBG_WORKSPACE_TTL_SECONDS", WorkspaceManager.DEFAULT_TTL_SECONDS))
+CACHE_DIR = BASE_DIR / "cache"
+JOBS_DIR = BASE_DIR / "jobs"
+JOBS_DIR.mkdir(exist_ok=True)
+WARM_NER_MODEL = os.environ.get("JBG_WARM_NER_MODEL", "no").lower() in ("1", "yes", "true")
+JOB_WORKERS = int(os.environ.get("JBG_JOB_WORKERS", JobQueue.DEFAULT_MAX_WORKERS))
+# Kärnor per jobb för OCR; standard är maskinens kärnor delat med JOB_WORKERS
+JOB_CPUS = int(os.environ.get("JBG_JOB_CPUS", 0)) or None
+# Körlägen för /jobs; motsvarar JBGAnnualReportAnalyzer.EXECUTION_MODE_ONLINE och _BATCH
+EXECUTION_MODES = ("online", "batch")
 TITLE = "JBG nyckeltalsanalys"
 SUBTITLE = "Obs! För .PDF (eller .ZIP av .PDF)"
 TITLE_MASKING = "JBG filmaskning"
@@ -47,6 +66,83 @@ logger = logging.getLogger(__name__)
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 templates = Jinja2Templates(directory=BASE_DIR / "templates")
 
+job_store = JobStore(JOBS_DIR)
+job_queue = JobQueue(job_store, max_workers=JOB_WORKERS, log_file=LOG_FILE, cpus_per_job=JOB_CPUS)
+workspaces = WorkspaceManager(WORKSPACE_DIR, ttl_seconds=WORKSPACE_TTL_SECONDS)
+# Delas av alla maskeringsanrop, så att maskeringsprocesserna och deras NER-modeller återanvänds
+masker = PDFMasker()
+
+
+def create_workspace(workspace_id: str = None) -> tuple[str, Path]:
+    # Never remove the workspaces of jobs that have not finished
+    active_jobs = [job["id"] for job in job_store.list_by_status(JobStore.STATUS_QUEUED, JobStore.STATUS_RUNNING)]
+    return workspaces.create(workspace_id, keep=active_jobs)
+
+
+def save_upload(file: UploadFile, target_dir: Path) -> list:
+    """
+    Sparar den uppladdade filen i target_dir och returnerar namnen på de PDF:er den innehåller
+    """
+    filename = Path(file.filename).name
+    file_ext = filename.lower().split(".")[-1]
+    if file_ext not in ("zip", "pdf"):
+        raise FileTypeException(
+            message=f"{INVALID_FILETYPE_FOR}: {filename}. {FILES_ALLOWED}."
+        )
+
+    saved_path = target_dir / filename
+    with saved_path.open("wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+    # If a zip file, examine the directory structure (if any) such that only PDF:s are found
+    if file_ext == "zip":
+        with zipfile.ZipFile(saved_path, 'r') as zip_ref:
+            zip_members = [info for info in zip_ref.infolist() if not info.is_dir()]
+            for member in zip_members:
+                if not member.filename.lower().endswith(".pdf"):
+                    raise FileTypeException(
+                        message=f"{INVALID_FILETYPE_FOR}: {member.filename}. {FILES_ALLOWED}."
+                    )
+            return [member.filename for member in zip_members]
+    return [filename]
+
+
+def analysis_params(
+    filename: str, model: str, format: str, sources: str, use_masking: str, input_dir: Path, execution_mode: str = None
+) -> dict:
+    return {
+        "input_dir": str(input_dir),
+        "filename": filename,
+        "model": model,
+        "output_format": format,
+        "include_sources": sources == "yes",
+        "use_masking": use_masking == "yes",
+        "instruction_path": str(
+            BASE_DIR / "prompt" / "GPT-instruktioner.md" if not USE_COMPRESSED_GPT else \
+            BASE_DIR / "prompt" / "GPT-instruktioner_komprimerad.md"
+        ),
+        "metrics_path": str(BASE_DIR / "prompt" / "json" / "nyckeltalsdefinitioner.json"),
+        "fund_names_path": str(BASE_DIR / "src" / "json" / "kassor.json"),
+        "cache_dir": str(CACHE_DIR),
+        "execution_mode": execution_mode
+    }
+
+
+def job_status(job: dict) -> dict:
+    status = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "filename": job["params"].get("filename"),
+        "message": job["message"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"]
+    }
+    if job["status"] == JobStore.STATUS_DONE:
+        status["result_url"] = f"/jobs/{job['id']}/result"
+    return status
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {
@@ -82,129 +178,43 @@ async def upload_file(
     else:
         raise Exception(f"Illegal value of checkbox sources: {str(sources)}. Reason: {str(ex)}")
     
-    filename = file.filename
-    file_ext = filename.lower().split(".")[-1]
-
-    for f in UPLOAD_DIR.glob("*"):
-        if f.is_file():
-            f.unlink()
-        elif f.is_dir():
-            shutil.rmtree(f)
-
-    saved_path = UPLOAD_DIR / filename
-    with saved_path.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    filename = Path(file.filename).name
+    job_id, job_dir = create_workspace(JobStore.new_job_id())
 
     try:
-        extracted_files = []
-        
-        # If a zip file, examine the directory structure (if any) such that only PDF:s are found
-        if file_ext == "zip":
-            with zipfile.ZipFile(saved_path, 'r') as zip_ref:
-                # List all files in the archive, including paths
-                zip_members = [info for info in zip_ref.infolist() if not info.is_dir()]
-                
-                # Validate all files are PDFs
-                for member in zip_members:
-                    if not member.filename.lower().endswith(".pdf"):
-                        raise FileTypeException(
-                            message=f"{INVALID_FILETYPE_FOR}: {member.filename}. {FILES_ALLOWED}."
-                        )
-                
-                # Extract all valid files
-                zip_ref.extractall(UPLOAD_DIR)
-                extracted_files = [member.filename for member in zip_members]
-        
-        # Single PDF
-        elif file_ext == "pdf":
-            extracted_files = [filename]
-            
-        # all other cases
-        else:
-            raise FileTypeException(
-                message=f"{INVALID_FILETYPE_FOR}: {filename}. {FILES_ALLOWED}."
-            )
-
-        os.environ["OPENAI_API_KEY"] = apikey
-        analys = JBGAnnualReportAnalyzer(
-            upload_dir=UPLOAD_DIR,
-            instruction_path=\
-                BASE_DIR / "prompt" / "GPT-instruktioner.md" if not USE_COMPRESSED_GPT else \
-                BASE_DIR / "prompt" / "GPT-instruktioner_komprimerad.md",
-                metrics_path=BASE_DIR / "prompt" / "json" / "nyckeltalsdefinitioner.json",
-                use_masking = (use_masking == "yes")
+        extracted_files = save_upload(file, job_dir)
+
+        # The analysis runs in a worker process; the page polls /jobs/{job_id} for its status
+        job_queue.submit(
+            analysis_params(filename, model, format, sources, use_masking, job_dir), api_key=apikey, job_id=job_id
         )
-        analys.openai_client = OpenAI(api_key=apikey)
-
-        json_output_path = UPLOAD_DIR / f"{Path(filename).stem}_resultat.json"
-        
-        # Do analysis and take care of result
-        analys_result_path = analys.do_analysis(json_output_path, model=model)
-        if analys_result_path:
-            resultat_json = json.loads(analys_result_path.read_text(encoding="utf-8"))
-            
-            converter = JsonConverter(json_output_path, include_sources=(sources == "yes"))
-
-            if format == "csv":
-                output_path = UPLOAD_DIR / f"{Path(filename).stem}_resultat.csv"
-                converter.to_csv(output_path)
-
-            elif format == "xlsx":
-                output_path = UPLOAD_DIR / f"{Path(filename).stem}_resultat_by_fund.xlsx"
-                converter.to_excel_by_year(
-                    output_path, 
-                    key_def_path=BASE_DIR / "prompt" / "json" / "nyckeltalsdefinitioner.json",
-                    fund_names=BASE_DIR / "src" / "json" / "kassor.json"
-                )
-
-            elif format == "json":
-                # Already written by `do_analysis` → no action needed
-                output_path = json_output_path
-
-            else:
-                raise ValueError("Ogiltigt format valt.")
-            
-            download_filename = output_path.name
-
-            return templates.TemplateResponse("index.html", {
-                "request": request,
-                "title": TITLE,
-                "subtitle": SUBTITLE,
-                "title_masking": TITLE_MASKING, 
-                "subtitle_masking": SUBTITLE_MASKING, 
-                "message": f"{len(extracted_files)} fil(er) analyserade.",
-                "resultat": json.dumps(resultat_json, indent=2, ensure_ascii=False),
-                "download_filename": download_filename
-            })
-        else:
-            logger.warning(f"Inget resultat")
-            raise EmptyOutputException(message="Ingen fil verkar ha analyserats")
+        logger.info(f"Jobb {job_id} köat för {filename} ({len(extracted_files)} fil(er))")
 
-    except FileTypeException as ex:
-        logger.warning(f"Fel filtyp: {ex.message}")
         return templates.TemplateResponse("index.html", {
             "request": request,
             "title": TITLE,
             "subtitle": SUBTITLE,
             "title_masking": TITLE_MASKING, 
             "subtitle_masking": SUBTITLE_MASKING, 
-            "message": f"{ex.message}"
+            "message": f"{len(extracted_files)} fil(er) köade för analys.",
+            "job_id": job_id
         })
 
-    except EmptyOutputException as e:
-        logger.error(f"Ingen fil verkar ha analyserats: {str(e)}")
+    except FileTypeException as ex:
+        logger.warning(f"Fel filtyp: {ex.message}")
+        shutil.rmtree(job_dir, ignore_errors=True)
         return templates.TemplateResponse("index.html", {
             "request": request,
             "title": TITLE,
             "subtitle": SUBTITLE,
             "title_masking": TITLE_MASKING, 
             "subtitle_masking": SUBTITLE_MASKING, 
-            "message": f"Ett fel uppstod vid nyckeltalsanalysen: {str(e)}"
+            "message": f"{ex.message}"
         })
-    
+
     except Exception as e:
-        logger.error(f"Ett fel uppstod vid nyckeltalsanalysen: {str(e)}")
-        raise(e)
+        logger.error(f"Ett fel uppstod när analysen skulle köas: {str(e)}")
+        shutil.rmtree(job_dir, ignore_errors=True)
         return templates.TemplateResponse("index.html", {
             "request": request,
             "title": TITLE,
@@ -214,12 +224,12 @@ async def upload_file(
             "message": f"Fel vid analys: {str(e)}"
         })
 
-@app.get("/download/{filename}", response_class=FileResponse)
-async def download_file(filename: str):
-    file_path = UPLOAD_DIR / filename
-    if file_path.exists():
+@app.get("/download/{workspace_id}/{filename}", response_class=FileResponse)
+async def download_file(workspace_id: str, filename: str):
+    file_path = workspaces.resolve_file(workspace_id, filename)
+    if file_path:
         return FileResponse(path=file_path, filename=filename, media_type='application/octet-stream')
-    return {"error": "Filen finns inte"}
+    return JSONResponse(status_code=404, content={"error": "Filen finns inte"})
 
 @app.post("/mask", response_class=HTMLResponse)
 async def mask_only(
@@ -229,14 +239,17 @@ async def mask_only(
     try:
         # Spara fil
         filename = file.filename
-        saved_path = UPLOAD_DIR / filename
+        workspace_id, workspace_dir = create_workspace()
+        saved_path = workspace_dir / Path(filename).name
         with saved_path.open("wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
 
-        # Kör maskering
-        masker = PDFMasker()
+        # Kör maskering utanför event-loopen
         masked_output = saved_path.with_name(saved_path.stem + "_masked.pdf")
-        masked_output = Path(masker.do_masking(Path(saved_path), Path(masked_output)))
+        masked_output = await run_in_threadpool(masker.do_masking, Path(saved_path), Path(masked_output), logger)
+        if masked_output is None:
+            raise Exception("filen kunde inte maskeras")
+        masked_output = Path(masked_output)
 
         return templates.TemplateResponse("index.html", {
             "request": request,
@@ -246,6 +259,7 @@ async def mask_only(
             "subtitle_masking": SUBTITLE_MASKING, 
             "message": f"Filen '{filename}' maskerad.",
             "masked_filename": masked_output.name,
+            "workspace_id": workspace_id,
             "active_tab": "masking"
         })
 
@@ -260,3 +274,59 @@ async def mask_only(
             "message": f"Fel vid maskering: {str(e)}",
             "active_tab": "masking"
         })
+
+@app.post("/jobs")
+async def submit_job(
+    file: UploadFile = File(...),
+    model: str = Form(...),
+    apikey: str = Form(...),
+    format: str = Form(...),
+    sources: str = Form("no"),
+    use_masking: str = Form("no"),
+    execution_mode: str = Form("online")
+):
+    if format not in ("json", "csv", "xlsx"):
+        return JSONResponse(status_code=400, content={"error": "Ogiltigt format valt."})
+    # "batch" skickar chunkarna via OpenAI:s Batch API: billigare men klart inom 24 timmar
+    if execution_mode not in EXECUTION_MODES:
+        return JSONResponse(status_code=400, content={"error": f"Ogiltigt körläge, välj ett av {EXECUTION_MODES}."})
+
+    job_id, job_dir = create_workspace(JobStore.new_job_id())
+    try:
+        extracted_files = save_upload(file, job_dir)
+    except FileTypeException as ex:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return JSONResponse(status_code=400, content={"error": ex.message})
+
+    job_queue.submit(
+        analysis_params(Path(file.filename).name, model, format, sources, use_masking, job_dir, execution_mode),
+        api_key=apikey, job_id=job_id
+    )
+    logger.info(f"Jobb {job_id} köat för {file.filename} ({len(extracted_files)} fil(er))")
+    return JSONResponse(status_code=202, content=job_status(job_store.get(job_id)))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Jobbet finns inte"})
+    return job_status(job)
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Jobbet finns inte"})
+    if job["status"] != JobStore.STATUS_DONE:
+        return JSONResponse(status_code=409, content=job_status(job))
+    file_path = Path(job["params"]["input_dir"]) / job["result_filename"]
+    if not file_path.exists():
+        return JSONResponse(status_code=410, content={"error": "Resultatfilen finns inte längre"})
+    return FileResponse(path=file_path, filename=file_path.name, media_type='application/octet-stream')
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    status = job_queue.cancel(job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": "Jobbet finns inte"})
+    return job_status(job_store.get(job_id))
@@ -1,17 +1,27 @@
 from pathlib import Path
 import zipfile
 import json
-from typing import List, Union
-from openai import OpenAI, RateLimitError, Timeout, APIError
+from typing import List, Optional, Union
+from openai import OpenAI, RateLimitError, APITimeoutError, APIError, BadRequestError, PermissionDeniedError
 from app.src.JBGAnnualReportExceptions import FileTypeException 
+from app.src.JBGRateLimiter import RateLimiter, get_shared_rate_limiter
+from app.src.JBGResponseCache import ResponseCache
+from app.src.JBGPDFDocument import PDFDocument
+from app.src.JBGOCRPool import OCRPool, run_ocr, OCR_LANGUAGE, OCR_DESKEW
+from app.src.JBGOCRCache import OCRCache
+from app.src.JBGRelevanceFilter import RelevanceFilter
+from app.src.JBGPromptTemplates import PromptTemplates
+from app.src.JBGBatchRunner import BatchRunner
+from app.src.JBGResponseSchema import ResponseSchema, FreeformResponseParser
 from app.src.masking.JBGPDFMasking import PDFMasker
 import logging
-import fitz
 import tiktoken
 import time
-import ocrmypdf
+import threading
 import re
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -37,21 +47,76 @@ class JBGAnnualReportAnalyzer:
     MAX_TOKEN_OVERLAP = 1000
     MAX_TOKEN_OVERLAP_REDUCTION = 200
     USE_TOKEN_OVERLAP = True
+    USE_STRUCTURE_AWARE_CHUNKING = True
+    USE_RELEVANCE_FILTER = True
+    RELEVANCE_THRESHOLD_RATE = 0.2
+    RELEVANCE_NEIGHBOUR_PAGES = 1
+    EXTRACTION_MODE_CHUNKED = "chunked"
+    EXTRACTION_MODE_TARGETED = "targeted"
+    DEFAULT_EXTRACTION_MODE = EXTRACTION_MODE_CHUNKED
+    MAX_PAGES_PER_METRIC = 4
+    DEFAULT_PROMPT_LAYOUT = PromptTemplates.LAYOUT_PREFIX_CACHED
+    EXECUTION_MODE_ONLINE = "online"
+    EXECUTION_MODE_BATCH = "batch"
+    DEFAULT_EXECUTION_MODE = EXECUTION_MODE_ONLINE
+    BATCH_POLL_INTERVAL = 30.0
+    RESPONSE_FORMAT_TEXT = "text"
+    RESPONSE_FORMAT_JSON_SCHEMA = "json_schema"
+    DEFAULT_RESPONSE_FORMAT = RESPONSE_FORMAT_JSON_SCHEMA
+    USE_STREAMING = True
+    FINISH_REASON_INVALID_JSON = "invalid_json"
     DEFAULT_MODEL = "gpt-4o"
     DEFAULT_OPENAI_TEMPERATURE = 0.3
     GPT_5_TEMPERATURE = 1.0
     MODEL_GPT_5_MARKER = "gpt-5"
     DEFAULT_OPENAI_TOP_P = 1
-    DEFAULT_SHORT_SLEEP_TIME = 1
-    DEFAULT_LONG_SLEEP_TIME = 5
     TEXT_GAIN_FOR_OCR_CONVERSION = 1.5
+    MIN_TEXT_DENSITY_FOR_TEXT_LAYER = 2.0
+    MIN_IMAGE_COVERAGE_FOR_OCR = 0.1
+    USE_LOCAL_PAGE_OFFSET_DETECTION = True
+    PAGE_NUMBER_MARGIN_RATE = 0.12
+    USE_LOCAL_YEAR_DETECTION = True
+    MIN_PLAUSIBLE_YEAR = 2000
+    NUM_COVER_PAGES = 2
+    COVER_PAGE_YEAR_WEIGHT = 3.0
+    YEAR_KEY_PHRASE_WEIGHT = 5.0
+    YEAR_KEY_PHRASE_WINDOW = 2
+    YEAR_KEY_PHRASES = ("årsredovisning", "räkenskapsår", "verksamhetsår", "bokslut")
+    _YEAR_RE = re.compile(r"(?<!\d)(\d{4})(?!\d)")
+    _PAGE_MARKER_RE = re.compile(r"(?=\[Sida [^\]\n]+\])")
+    _PAGE_MARKER_LINE_RE = re.compile(r"\[Sida [^\]\n]+\][^\S\n]*\n?")
+    _SECTION_HEADING_RE = re.compile(
+        r"^[^\S\n]*(?:Förvaltningsberättelse|Resultaträkning|Balansräkning|Kassaflödesanalys|"
+        r"Flerårsöversikt|Noter|Not\s+\d+|Revisionsberättelse)\b[^\n]{0,60}$",
+        re.IGNORECASE | re.MULTILINE
+    )
+    _GPT5_RE = re.compile(r"^gpt-5", re.IGNORECASE)      # gpt-5, gpt-5-mini, gpt-5-pro, etc.
+    _GPT4O_RE = re.compile(r"^(gpt-4o|o\d)", re.IGNORECASE)  # gpt-4o, gpt-4o-mini, ev. o-…-modeller
+    _GPT4_STD_RE = re.compile(r"^gpt-4(?!o)", re.IGNORECASE) # gpt-4, gpt-4-0613 osv.
+    _GPT35_RE = re.compile(r"^gpt-3\.5", re.IGNORECASE)
+    _PRINTED_PAGE_NUMBER_RE = re.compile(
+        r"^(?:sida\s*)?[-–]?\s*(\d{1,3})\s*[-–]?(?:\s*(?:\(\s*\d{1,3}\s*\)|/\s*\d{1,3}|av\s+\d{1,3}))?$",
+        re.IGNORECASE
+    )
+    MAX_CONCURRENT_CHUNKS = 4
     
     def __init__(
         self,
         upload_dir: Union[str, Path, List[Union[str, Path]]],
         instruction_path: Union[str, Path],
         metrics_path: Union[str, Path],
-        use_masking: bool = False
+        use_masking: bool = False,
+        max_concurrent_chunks: int = None,
+        rate_limiter: RateLimiter = None,
+        cache_dir: Union[str, Path] = None,
+        ocr_workers: int = None,
+        cpu_budget: int = None,
+        extraction_mode: str = None,
+        prompt_layout: str = None,
+        execution_mode: str = None,
+        openai_base_url: str = None,
+        response_format: str = None,
+        openai_api_key: str = None
     ):
         # Accept list of paths or a folder
         if isinstance(upload_dir, (list, tuple)):
@@ -66,29 +131,60 @@ class JBGAnnualReportAnalyzer:
 
         self.instruction_path = Path(instruction_path)
         self.metrics_path = Path(metrics_path)
+        self.prompt_templates = PromptTemplates.get(self.instruction_path, self.metrics_path)
+        self.prompt_layout = prompt_layout if prompt_layout else self.DEFAULT_PROMPT_LAYOUT
+        self.prompt_token_usage = {"prompt_tokens": 0, "cached_tokens": 0}
+        self._prompt_token_usage_lock = threading.Lock()
         self.use_masking = use_masking
-        self.openai_client = OpenAI()
+        self.max_concurrent_chunks = max(1, max_concurrent_chunks or self.MAX_CONCURRENT_CHUNKS)
+        self.rate_limiter = rate_limiter if rate_limiter else get_shared_rate_limiter()
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.response_cache = ResponseCache(self.cache_dir / "responses") if self.cache_dir else None
+        self.ocr_cache = OCRCache(self.cache_dir / "ocr") if self.cache_dir else None
+        self.extraction_mode = extraction_mode if extraction_mode else self.DEFAULT_EXTRACTION_MODE
+        if self.extraction_mode not in (self.EXTRACTION_MODE_CHUNKED, self.EXTRACTION_MODE_TARGETED):
+            raise ValueError(f"Unknown extraction mode: {self.extraction_mode}")
+        self.execution_mode = execution_mode if execution_mode else self.DEFAULT_EXECUTION_MODE
+        if self.execution_mode not in (self.EXECUTION_MODE_ONLINE, self.EXECUTION_MODE_BATCH):
+            raise ValueError(f"Unknown execution mode: {self.execution_mode}")
+        self.response_format = response_format if response_format else self.DEFAULT_RESPONSE_FORMAT
+        if self.response_format not in (self.RESPONSE_FORMAT_TEXT, self.RESPONSE_FORMAT_JSON_SCHEMA):
+            raise ValueError(f"Unknown response format: {self.response_format}")
+        self.response_schema = None
+        if self.response_format == self.RESPONSE_FORMAT_JSON_SCHEMA:
+            self.response_schema = ResponseSchema(self.prompt_templates.metrics)
+        self.use_streaming = self.USE_STREAMING
+        self.ocr_pool = OCRPool(max_workers=ocr_workers, cpu_budget=cpu_budget)
+        self._ocr_outputs = {}
+        self.openai_base_url = openai_base_url
+        # Nyckeln skickas direkt till klienten i stället för via os.environ, som delas av alla anrop i processen
+        self.openai_client = OpenAI(api_key=openai_api_key, base_url=openai_base_url)
 
     def _extract_zip(self, zip_path: Path) -> List[Path]:
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
             zip_ref.extractall(self.upload_dir)
         return [f for f in self.upload_dir.glob("*.pdf")]
 
-    def _find_page_number_offset(self, pdf_path: Path) -> int:
+    def _load_document(self, pdf_path: Path) -> PDFDocument:
+        return PDFDocument.load(pdf_path, cache_dir=self.cache_dir / "documents" if self.cache_dir else None)
+
+    def _find_page_number_offset(self, pdf_path: Path, document: PDFDocument = None) -> int:
         try:
-            doc = fitz.open(pdf_path)
+            if document is None:
+                document = self._load_document(pdf_path)
+            if self.USE_LOCAL_PAGE_OFFSET_DETECTION:
+                local_offset, confidence = self._detect_page_number_offset_locally(document)
+                if confidence >= self.MIN_OFFSET_AGREEMENT_RATE:
+                    logger.info(f"Page numbering offset {local_offset} found locally with {round(confidence,2)} agreement rate")
+                    return local_offset
+                logger.info(f"Local page offset detection uncertain ({round(confidence,2)}). Falling back to GPT.")
             i = 0
             page_offset = -1
             offsets = {}
-            first_openai_call = True
-            for page in doc:
+            prompt = self._prompt_instructions_pdf_page_offset()
+            for page_text in document.page_texts:
                 i += 1
-                if first_openai_call:
-                    prompt = self._prompt_instructions_pdf_page_offset()
-                    first_openai_call = False
-                else:
-                    time.sleep(self.DEFAULT_SHORT_SLEEP_TIME)
-                response = self._make_openai_api_call(prompt, f"[Sida {i}]:\n" + page.get_text())
+                response = self._make_openai_api_call(prompt, f"[Sida {i}]:\n" + page_text)
                 logger.debug(f"GPT-rådata:\n{response}")
                 try:
                     new_offset = int(response.strip())
@@ -112,23 +208,103 @@ class JBGAnnualReportAnalyzer:
             logger.warning(f"Could not extract pdf page number offset from {pdf_path.name}: {e}. Using standard value.")
             return self.PAGE_OFFSET
 
+    def _find_printed_page_numbers(self, page_lines: List[tuple], page_height: float) -> List[int]:
+        """
+        Returnerar kandidater till tryckta sidnummer i sidans sidhuvud och sidfot
+        """
+        margin = page_height * self.PAGE_NUMBER_MARGIN_RATE
+        candidates = []
+        for y0, y1, text in page_lines:
+            if y1 > margin and y0 < page_height - margin:
+                continue
+            match = self._PRINTED_PAGE_NUMBER_RE.match(text.strip())
+            if match:
+                candidates.append(int(match.group(1)))
+        return candidates
+
+    def _detect_page_number_offset_locally(self, document: PDFDocument) -> tuple[int, float]:
+        """
+        Röstar fram sidnummerförskjutningen utifrån tryckta sidnummer i sidhuvud och sidfot.
+        Returnerar förskjutningen och andelen sidor med kandidater som stöder den.
+        """
+        offsets = {}
+        pages_with_candidates = 0
+        for i, (page_lines, (_, page_height)) in enumerate(zip(document.page_lines, document.page_sizes)):
+            page_offsets = {
+                (i + 1) - printed for printed in self._find_printed_page_numbers(page_lines, page_height)
+            }
+            page_offsets = {offset for offset in page_offsets if abs(offset) <= self.OFFSET_LIMIT}
+            if not page_offsets:
+                continue
+            pages_with_candidates += 1
+            for offset in page_offsets:
+                offsets[offset] = offsets.get(offset, 0) + 1
+        logger.debug(f"Locally calculated offsets: {offsets}")
+
+        if not offsets or pages_with_candidates < min(self.MIN_CHECK_OFFSETS, document.page_count):
+            return self.PAGE_OFFSET, 0.0
+        page_offset = max(offsets, key=offsets.get)
+        return page_offset, float(offsets[page_offset]) / float(pages_with_candidates)
+
+    def _detect_primary_year_locally(self, document: PDFDocument) -> tuple[int, float]:
+        """
+        Röstar fram huvudåret utifrån årtal nära nyckelfraser som "Årsredovisning" och
+        "räkenskapsåret", på samma rad eller inom YEAR_KEY_PHRASE_WINDOW rader, samt årtal
+        på förstasidorna. Jämförelsekolumner med föregående år i tabellerna påverkar därmed
+        inte utfallet. På rader med flera årtal räknas bara det senaste årtalet.
+        Saknas sådan kontext används alla årtal i texten.
+        Returnerar det mest troliga året och dess andel av den viktade rösten.
+        """
+        context_scores = {}
+        all_scores = {}
+        max_year = time.localtime().tm_year + 1
+        for i, page_text in enumerate(document.page_texts):
+            is_cover_page = i < self.NUM_COVER_PAGES
+            page_weight = self.COVER_PAGE_YEAR_WEIGHT if is_cover_page else 1.0
+            lines = page_text.split("\n")
+            key_lines = [j for j, line in enumerate(lines) if any(phrase in line.lower() for phrase in self.YEAR_KEY_PHRASES)]
+            for j, line in enumerate(lines):
+                years = [int(year) for year in self._YEAR_RE.findall(line)]
+                years = [year for year in years if self.MIN_PLAUSIBLE_YEAR <= year <= max_year]
+                if not years:
+                    continue
+                year = max(years)
+                all_scores[year] = all_scores.get(year, 0.0) + page_weight
+                distance = min((abs(j - k) for k in key_lines), default=None)
+                if distance == 0:
+                    weight = page_weight * self.YEAR_KEY_PHRASE_WEIGHT
+                elif distance is not None and distance <= self.YEAR_KEY_PHRASE_WINDOW:
+                    weight = page_weight * self.YEAR_KEY_PHRASE_WEIGHT / (1 + distance)
+                elif is_cover_page:
+                    weight = page_weight
+                else:
+                    continue
+                context_scores[year] = context_scores.get(year, 0.0) + weight
+        logger.debug(f"Lokalt viktade årfrekvenser: {context_scores} (alla årtal: {all_scores})")
+
+        year_scores = context_scores if sum(context_scores.values()) >= self.YEAR_KEY_PHRASE_WEIGHT else all_scores
+        total_score = sum(year_scores.values())
+        if not year_scores or total_score < self.MIN_CHECK_YEARS:
+            return self.FALLBACK_YEAR, 0.0
+        most_likely_year = max(year_scores, key=year_scores.get)
+        return most_likely_year, year_scores[most_likely_year] / total_score
+
     def _find_primary_year_from_pdf(self, pdf_path: Path) -> int:
         try:
-            doc = fitz.open(pdf_path)
+            document = self._load_document(pdf_path)
+            if self.USE_LOCAL_YEAR_DETECTION:
+                local_year, confidence = self._detect_primary_year_locally(document)
+                if confidence >= self.MIN_YEAR_AGREEMENT_RATE:
+                    logger.info(f"Huvudår {local_year} hittat lokalt med {round(confidence,2)} dominans")
+                    return local_year
+                logger.info(f"Lokal årtolkning osäker ({round(confidence,2)}). Frågar GPT.")
             year_counts = {}
             most_likely_year = -1
-            first_openai_call = True
+            prompt = self._prompt_instructions_pdf_actual_year()
             page_counter = 0
 
-            for page in doc:
+            for text in document.page_texts:
                 page_counter += 1
-                if first_openai_call:
-                    prompt = self._prompt_instructions_pdf_actual_year()
-                    first_openai_call = False
-                else:
-                    time.sleep(self.DEFAULT_SHORT_SLEEP_TIME)
-
-                text = page.get_text()
                 response = self._make_openai_api_call(prompt, f"[Sida {page_counter}]:\n{text}")
                 logger.debug(f"GPT-rådata (årtolkning):\n{response}")
 
@@ -164,47 +340,117 @@ class JBGAnnualReportAnalyzer:
     def _extract_text_from_pdf_from_pdf(self, pdf_path: Path) -> str:
 
         try:
-            original_doc = fitz.open(pdf_path)
-            original_text = self._extract_text_from_pdf(original_doc, max(self._find_page_number_offset(pdf_path), 0)).strip()
-            original_len = len(original_text)
+            original_doc = self._load_document(pdf_path)
+            logger.info(f"Original text length: {original_doc.total_char_count}")
 
-            logger.info(f"Original text length: {original_len}")
+            # Run OCR only on pages without a usable text layer
+            pages_to_ocr = self._find_pages_needing_ocr(original_doc)
+            if not pages_to_ocr:
+                logger.info(f"All pages of {pdf_path.name} have a usable text layer. Skipping OCR.")
+                return self._extract_text_from_pdf(original_doc, max(self._find_page_number_offset(pdf_path, original_doc), 0)).strip()
 
-            # Run OCR unconditionally
-            ocr_path = pdf_path.with_name(f"{pdf_path.stem}_ocr.pdf")
             try:
-                ocrmypdf.ocr(
-                    input_file=str(pdf_path),
-                    output_file=str(ocr_path),
-                    language='swe',
-                    deskew=True
-                )
-                ocr_doc = fitz.open(ocr_path)
-                ocr_text = self._extract_text_from_pdf(ocr_doc, max(self._find_page_number_offset(ocr_path), 0)).strip()
-                ocr_len = len(ocr_text)
-                logger.info(f"OCR text length: {ocr_len}")
-
-                # Use OCR if text gain is significant (e.g. 50% more)
-                if ocr_len > original_len * self.TEXT_GAIN_FOR_OCR_CONVERSION:
-                    logger.info(f"Using OCR-enhanced version of {pdf_path.name}")
-                    return ocr_text
+                if pdf_path in self._ocr_outputs:
+                    ocr_path = self._ocr_outputs[pdf_path]
+                    if ocr_path is None:
+                        raise RuntimeError("OCR in the process pool failed")
                 else:
+                    ocr_path = self._get_cached_ocr_output(original_doc, pages_to_ocr)
+                    if ocr_path is None:
+                        logger.info(f"Running OCR on {len(pages_to_ocr)} of {original_doc.page_count} pages in {pdf_path.name}")
+                        ocr_path = Path(run_ocr(
+                            pdf_path, self._ocr_output_path(pdf_path), pages_to_ocr, jobs=self.ocr_pool.cpu_count
+                        ))
+                        self._store_ocr_output(original_doc, pages_to_ocr, ocr_path)
+                ocr_doc = self._load_document(ocr_path)
+
+                # Use OCR text for a page if text gain is significant (e.g. 50% more)
+                improved_pages = [
+                    index for index in pages_to_ocr
+                    if len(ocr_doc.page_texts[index].strip()) > original_doc.page_char_counts[index] * self.TEXT_GAIN_FOR_OCR_CONVERSION
+                ]
+                if not improved_pages:
                     logger.info(f"OCR did not significantly improve content. Using original.")
-                    return original_text
+                    return self._extract_text_from_pdf(original_doc, max(self._find_page_number_offset(pdf_path, original_doc), 0)).strip()
+
+                logger.info(f"Using OCR-enhanced text for {len(improved_pages)} page(s) of {pdf_path.name}")
+                merged_doc = original_doc.with_pages_from(ocr_doc, improved_pages)
+                logger.info(f"OCR text length: {merged_doc.total_char_count}")
+                return self._extract_text_from_pdf(merged_doc, max(self._find_page_number_offset(pdf_path, merged_doc), 0)).strip()
             except Exception as ocr_err:
                 logger.warning(f"OCR failed for {pdf_path.name}: {ocr_err}")
-                return original_text
+                return self._extract_text_from_pdf(original_doc, max(self._find_page_number_offset(pdf_path, original_doc), 0)).strip()
         except Exception as e:
             logger.warning(f"Text extraction failed for {pdf_path.name}: {e}")
             return ""
 
-    def _document_contains_retreivable_text(self, doc) -> bool:
-        for page in doc:
-            if page.get_text().strip():  # strip whitespace to be safe
-                return True
-        return False
+    def _ocr_output_path(self, pdf_path: Path) -> Path:
+        return pdf_path.with_name(f"{pdf_path.stem}_ocr.pdf")
+
+    def _prefetch_ocr(self, pdf_paths: List[Path]):
+        """
+        Kör OCR för alla dokument som behöver det parallellt i en processpool innan
+        analysen, så att textextraktionen sedan kan använda det färdiga resultatet
+        """
+        requests = []
+        documents = {}
+        for pdf_path in pdf_paths:
+            try:
+                document = self._load_document(pdf_path)
+                pages_to_ocr = self._find_pages_needing_ocr(document)
+            except Exception as e:
+                logger.warning(f"Could not examine text layer of {pdf_path.name}: {e}")
+                continue
+            if not pages_to_ocr:
+                continue
+            cached_path = self._get_cached_ocr_output(document, pages_to_ocr)
+            if cached_path:
+                self._ocr_outputs[pdf_path] = cached_path
+            else:
+                documents[pdf_path] = (document, pages_to_ocr)
+                requests.append((pdf_path, self._ocr_output_path(pdf_path), pages_to_ocr))
+        if requests:
+            ocr_outputs = self.ocr_pool.ocr_documents(requests)
+            for pdf_path, ocr_path in ocr_outputs.items():
+                if ocr_path:
+                    document, pages_to_ocr = documents[pdf_path]
+                    self._store_ocr_output(document, pages_to_ocr, ocr_path)
+            self._ocr_outputs.update(ocr_outputs)
+
+    def _get_cached_ocr_output(self, document: PDFDocument, pages_to_ocr: List[int]) -> Optional[Path]:
+        if not self.ocr_cache:
+            return None
+        cached_path = self.ocr_cache.get(
+            OCRCache.make_key(document.file_hash, pages_to_ocr, OCR_LANGUAGE, OCR_DESKEW),
+            self._ocr_output_path(document.path)
+        )
+        if cached_path:
+            logger.info(f"Using cached OCR output for {document.path.name}")
+        return cached_path
+
+    def _store_ocr_output(self, document: PDFDocument, pages_to_ocr: List[int], ocr_path: Path):
+        if not self.ocr_cache:
+            return
+        try:
+            self.ocr_cache.put(OCRCache.make_key(document.file_hash, pages_to_ocr, OCR_LANGUAGE, OCR_DESKEW), ocr_path)
+        except Exception as e:
+            logger.warning(f"Could not cache OCR output for {document.path.name}: {e}")
+
+    def _find_pages_needing_ocr(self, document: PDFDocument) -> List[int]:
+        """
+        Returnerar index för sidor som saknar ett användbart textlager, dvs. sidor med
+        låg texttäthet som till stor del består av bilder (t.ex. inskannade sidor)
+        """
+        return [
+            index for index in range(document.page_count)
+            if document.page_text_density(index) < self.MIN_TEXT_DENSITY_FOR_TEXT_LAYER
+            and document.page_image_coverage[index] >= self.MIN_IMAGE_COVERAGE_FOR_OCR
+        ]
 
-    def _extract_text_from_pdf(self, doc, offset: int) -> str:
+    def _document_contains_retreivable_text(self, document: PDFDocument) -> bool:
+        return document.has_retrievable_text()
+
+    def _extract_text_from_pdf(self, document: PDFDocument, offset: int) -> str:
         
         def page_label(page_number, page_number_offset):
             page_label = page_number - page_number_offset
@@ -228,14 +474,14 @@ class JBGAnnualReportAnalyzer:
             return result
         
         return "\n\n".join([
-            f"[Sida {page_label(i+1, offset)}]\n{page.get_text()}"
-            for i, page in enumerate(doc)
+            f"[Sida {page_label(i+1, offset)}]\n{page_text}"
+            for i, page_text in enumerate(document.page_texts)
         ])
         
     def _merge_broken_key_number_lines(self, text: str, key_number_terms: List[str]=None) -> str:
         
         if not key_number_terms:
-            key_number_terms = self._extract_key_number_term()
+            key_number_terms = self._extract_key_number_terms()
         
         lines = text.split("\n")
         terms = {term.lower() for term in key_number_terms}
@@ -267,17 +513,13 @@ class JBGAnnualReportAnalyzer:
         return "\n".join(merged)
     
     def _extract_key_number_terms(self) -> List[str]:
-        metrics = self._load_metrics(dump=False)
-        key_number_terms = [metric.get(self.METRIC_KEY_NUMBER_KEY) for metric in metrics]
-        for metric in metrics:
-            key_number_terms = key_number_terms + [alt_metric for alt_metric in metric.get(self.METRIC_KEY_NUMBER_ALTERNATE_KEY)]
-        
-        return key_number_terms
+        return self.prompt_templates.key_number_terms
     
     @staticmethod
+    @lru_cache(maxsize=None)
     def _get_encoder_for_model(model_name: str):
         """
-        Returnerar en tiktoken-encoder för angiven modell.
+        Returnerar en tiktoken-encoder för angiven modell. Resultatet memoiseras per modell.
         1) Försöker modell-specifik encoder via encoding_for_model
         2) Faller tillbaka enligt känd praxis:
         - GPT-5*  -> "o200k_base"
@@ -287,11 +529,6 @@ class JBGAnnualReportAnalyzer:
         - Annat   -> "o200k_base" (säkert val för nyare modeller)
         """
         
-        _GPT5_RE = re.compile(r"^gpt-5", re.IGNORECASE)      # gpt-5, gpt-5-mini, gpt-5-pro, etc.
-        _GPT4O_RE = re.compile(r"^(gpt-4o|o\d)", re.IGNORECASE)  # gpt-4o, gpt-4o-mini, ev. o-…-modeller
-        _GPT4_STD_RE = re.compile(r"^gpt-4(?!o)", re.IGNORECASE) # gpt-4, gpt-4-0613 osv.
-        _GPT35_RE = re.compile(r"^gpt-3\.5", re.IGNORECASE)
-        
         # 1) Försök med tiktokens inbyggda mappning
         try:
             return tiktoken.encoding_for_model(model_name)
@@ -299,11 +536,11 @@ class JBGAnnualReportAnalyzer:
             pass
 
         # 2) Heuristiska fallbacks
-        if _GPT5_RE.match(model_name):
+        if JBGAnnualReportAnalyzer._GPT5_RE.match(model_name):
             return tiktoken.get_encoding("o200k_base")
-        if _GPT4O_RE.match(model_name):
+        if JBGAnnualReportAnalyzer._GPT4O_RE.match(model_name):
             return tiktoken.get_encoding("o200k_base")
-        if _GPT4_STD_RE.match(model_name) or _GPT35_RE.match(model_name):
+        if JBGAnnualReportAnalyzer._GPT4_STD_RE.match(model_name) or JBGAnnualReportAnalyzer._GPT35_RE.match(model_name):
             return tiktoken.get_encoding("cl100k_base")
 
         # Sista utväg: anta nyare tokenizer
@@ -313,19 +550,171 @@ class JBGAnnualReportAnalyzer:
         enc = JBGAnnualReportAnalyzer._get_encoder_for_model(model)
         return len(enc.encode(text))
 
+    def _split_text_on_page_markers(self, text: str) -> List[str]:
+        """
+        Delar texten i sidor vid sidmarkeringarna ([Sida N]) utan att ändra något tecken
+        """
+        return [page for page in self._PAGE_MARKER_RE.split(text) if page]
+
     def _chunk_text(self, text: str, max_tokens: int, model: str) -> List[str]:
-        words = text.split()
+        """
+        Packar hela sidor i chunks om högst max_tokens tokens. Varje sida tokeniseras en
+        gång och bara sidor som själva är större än max_tokens delas mitt i.
+        """
+        enc = JBGAnnualReportAnalyzer._get_encoder_for_model(model)
         chunks, current_chunk = [], []
         token_count = 0
-        for word in words:
-            token_count += self._count_tokens(word + " ", model)
-            current_chunk.append(word)
-            if token_count >= max_tokens:
-                chunks.append(" ".join(current_chunk))
-                current_chunk = []
-                token_count = 0
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
+
+        def flush():
+            nonlocal current_chunk, token_count
+            if current_chunk:
+                chunk = "".join(current_chunk).strip()
+                if chunk:
+                    chunks.append(chunk)
+            current_chunk, token_count = [], 0
+
+        for page in self._split_text_on_page_markers(text):
+            tokens = enc.encode(page)
+            if len(tokens) > max_tokens:
+                flush()
+                for start in range(0, len(tokens), max_tokens):
+                    chunks.append(enc.decode(tokens[start:start + max_tokens]).strip())
+                continue
+            if token_count + len(tokens) > max_tokens:
+                flush()
+            current_chunk.append(page)
+            token_count += len(tokens)
+        flush()
+        return chunks
+
+    def _filter_relevant_pages(self, text: str) -> str:
+        """
+        Behåller bara sidor som sannolikt innehåller nyckeltal, samt deras grannsidor
+        """
+        pages = self._split_text_on_page_markers(text)
+        relevance_filter = RelevanceFilter.from_metrics_file(self.metrics_path)
+        selected = relevance_filter.select_pages(pages, self.RELEVANCE_THRESHOLD_RATE, self.RELEVANCE_NEIGHBOUR_PAGES)
+        logger.info(f"Relevance filter kept {len(selected)} of {len(pages)} page(s)")
+        return "".join(pages[index] for index in selected)
+
+    def _build_targeted_chunks(self, text: str, the_year: int, model: str) -> tuple[List[str], List[str], list]:
+        """
+        Bygger ett index från varje nyckeltal till sidorna där det (eller en alternativ
+        benämning) förekommer och grupperar nyckeltal som delar sidor. Varje grupp skickas
+        med enbart sina sidor och enbart sina nyckeltalsdefinitioner, och med JSON-schema
+        ett schema som bara kräver gruppens nyckeltal.
+        Returnerar chunks och motsvarande systemprompter och svarsscheman.
+        """
+        pages = self._split_text_on_page_markers(text)
+        relevance_filter = RelevanceFilter.from_metrics_file(self.metrics_path)
+        metric_pages = relevance_filter.metric_page_index(pages, self.MAX_PAGES_PER_METRIC)
+        metrics = {metric.get(self.METRIC_KEY_NUMBER_KEY): metric for metric in self._load_metrics(dump=False)}
+
+        # Nyckeltal som inte nämns någonstans får leta bland de mest relevanta sidorna
+        unlocated = [name for name in metrics if not metric_pages.get(name)]
+        if unlocated:
+            scores = relevance_filter.score_pages(pages)
+            best_pages = sorted(range(len(pages)), key=lambda index: -scores[index])[:self.MAX_PAGES_PER_METRIC]
+            for name in unlocated:
+                metric_pages[name] = sorted(best_pages)
+            logger.info(f"{len(unlocated)} metric(s) not found by name, using the most relevant pages: {unlocated}")
+
+        # Gruppera nyckeltal som delar sidor så länge gruppens sidor ryms i MAX_TOKENS
+        enc = JBGAnnualReportAnalyzer._get_encoder_for_model(model)
+        page_tokens = [len(enc.encode(page)) for page in pages]
+        clusters = []
+        for name in sorted(metrics, key=lambda name: (metric_pages[name][:1], name)):
+            name_pages = set(metric_pages[name])
+            for cluster in clusters:
+                union = cluster[0] | name_pages
+                if cluster[0] & name_pages and sum(page_tokens[index] for index in union) <= self.MAX_TOKENS:
+                    cluster[0] = union
+                    cluster[1].append(name)
+                    break
+            else:
+                clusters.append([name_pages, [name]])
+
+        chunks, prompts, schemas = [], [], []
+        for cluster_pages, names in clusters:
+            cluster_metrics = [metrics[name] for name in names]
+            prompt = self._build_system_prompt(the_year=the_year, metrics=cluster_metrics)
+            schema = ResponseSchema(cluster_metrics) if self.response_schema else None
+            cluster_text = "".join(pages[index] for index in sorted(cluster_pages))
+            if sum(page_tokens[index] for index in cluster_pages) > self.MAX_TOKENS:
+                cluster_chunks = self._chunk_text_by_sections(cluster_text, self.MAX_TOKENS, self.MAX_TOKEN_OVERLAP, model)
+            else:
+                cluster_chunks = [cluster_text.strip()]
+            logger.debug(f"Metric cluster {names} uses pages {sorted(cluster_pages)}")
+            chunks.extend(cluster_chunks)
+            prompts.extend([prompt] * len(cluster_chunks))
+            schemas.extend([schema] * len(cluster_chunks))
+        logger.info(f"{len(metrics)} metric(s) grouped into {len(clusters)} page cluster(s)")
+        return chunks, prompts, schemas
+
+    def _split_text_into_sections(self, text: str) -> List[str]:
+        """
+        Delar texten i avsnitt som börjar vid rubriker som Resultaträkning, Balansräkning,
+        Noter och Flerårsöversikt. Ett avsnitt som börjar mitt på en sida får sidans
+        sidmarkering först så att källhänvisningen följer med.
+        """
+        sections, current_section = [], []
+
+        def flush():
+            nonlocal current_section
+            section = "".join(current_section)
+            if section.strip():
+                sections.append(section)
+            current_section = []
+
+        for page in self._split_text_on_page_markers(text):
+            marker_match = self._PAGE_MARKER_LINE_RE.match(page)
+            marker = marker_match.group(0) if marker_match else ""
+            if marker and not marker.endswith("\n"):
+                marker += "\n"
+            body = page[marker_match.end():] if marker_match else page
+            heading_starts = [match.start() for match in self._SECTION_HEADING_RE.finditer(body)]
+            if not heading_starts or body[:heading_starts[0]].strip():
+                current_section.append(marker + body[:heading_starts[0]] if heading_starts else marker + body)
+            for i, start in enumerate(heading_starts):
+                end = heading_starts[i + 1] if i + 1 < len(heading_starts) else len(body)
+                flush()
+                current_section.append(marker + body[start:end])
+        flush()
+        return sections
+
+    def _chunk_text_by_sections(
+        self,
+        text: str,
+        max_tokens: int,
+        max_overlap_tokens: Union[int, float],
+        model: str = "gpt-4o"
+    ) -> List[str]:
+        """
+        Packar hela avsnitt (t.ex. balansräkningen eller en not) i chunks om högst max_tokens.
+        Endast avsnitt som ensamma är större än max_tokens delas, och då med överlapp.
+        """
+        enc = JBGAnnualReportAnalyzer._get_encoder_for_model(model)
+        chunks, current_chunk = [], []
+        token_count = 0
+
+        def flush():
+            nonlocal current_chunk, token_count
+            chunk = "".join(current_chunk).strip()
+            if chunk:
+                chunks.append(chunk)
+            current_chunk, token_count = [], 0
+
+        for section in self._split_text_into_sections(text):
+            num_tokens = len(enc.encode(section))
+            if num_tokens > max_tokens:
+                flush()
+                chunks.extend(self._chunk_text_with_overlap(section, max_tokens, max_overlap_tokens, model))
+                continue
+            if token_count + num_tokens > max_tokens:
+                flush()
+            current_chunk.append(section)
+            token_count += num_tokens
+        flush()
         return chunks
 
     def _chunk_text_with_overlap(
@@ -405,48 +794,19 @@ class JBGAnnualReportAnalyzer:
         return chunks
 
     def _load_instruction(self) -> str:
-        return self.instruction_path.read_text(encoding=self.STANDARD_ENCODING)
+        return self.prompt_templates.instruction
 
     def _load_metrics(self, dump : bool = True) -> str:
-        metrics = json.loads(self.metrics_path.read_text(encoding=self.STANDARD_ENCODING))
         if dump:
-            return json.dumps(metrics, ensure_ascii=False, indent=2)
+            return self.prompt_templates.metrics_json
         else:
-            return metrics
+            return self.prompt_templates.metrics
 
-    def _build_request_text(self, extracted_text: str) -> str:
-       
-        request_text = f"""
-            Analysera följande årsredovisningsutdrag:
-            ----------------
-            {extracted_text}
-            ----------------
-            Returnera endast en giltig JSON-struktur enligt instruktionerna – ingen annan text.
-        """
-        return request_text
+    def _build_request_text(self, extracted_text: str, the_year: int = None) -> str:
+        return PromptTemplates.request_text(extracted_text, the_year=the_year, layout=self.prompt_layout)
 
-    def _build_system_prompt(self, the_year: int = None):
-        
-        instruction = self._load_instruction()
-        metrics_json = self._load_metrics()
-        
-        if the_year:
-            system_prompt = f"""
-                {instruction}
-                -------------
-                Följande nyckeltal ska extraheras för {the_year}:
-                -------------
-                {metrics_json}
-            """
-        else:
-            system_prompt = f"""
-                {instruction}
-                -------------
-                Följande nyckeltal ska extraheras:
-                -------------
-                {metrics_json}
-            """
-        return system_prompt
+    def _build_system_prompt(self, the_year: int = None, metrics: List[dict] = None):
+        return self.prompt_templates.system_prompt(the_year=the_year, metrics=metrics, layout=self.prompt_layout)
     
     @staticmethod
     def get_permitted_temperature(gpt_model):
@@ -457,7 +817,11 @@ class JBGAnnualReportAnalyzer:
         except ValueError as ex:
             return JBGAnnualReportAnalyzer.DEFAULT_OPENAI_TEMPERATURE
 
-    def _make_openai_api_call(self, system_prompt, request_text: str, model: str = "") -> str:
+    def _get_response_format_parameter(self, response_schema: ResponseSchema = None) -> Optional[dict]:
+        response_schema = response_schema if response_schema else self.response_schema
+        return response_schema.response_format if response_schema else None
+
+    def _make_openai_api_call(self, system_prompt, request_text: str, model: str = "", response_format: dict = None) -> str:
         MODEL_TOKEN_LIMITS = {
             "gpt-5": 16384,
             "gpt-5-mini": 8192,
@@ -470,28 +834,49 @@ class JBGAnnualReportAnalyzer:
         }
 
         model_used = model if model else self.DEFAULT_MODEL
+        temperature = JBGAnnualReportAnalyzer.get_permitted_temperature(model_used)
+
+        # Återanvänd ett tidigare svar på exakt samma anrop om det finns
+        cache_key = None
+        if self.response_cache:
+            cache_key = ResponseCache.make_key(model_used, temperature, system_prompt, request_text, response_format)
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug(f"Using cached GPT response for key {cache_key}")
+                return cached_response
+
         max_retries = 5
         initial_delay = 1.5
         backoff_factor = 2.0
         attempt = 0
+        extra_parameters = {"response_format": response_format} if response_format else {}
 
         while attempt < max_retries:
+            reserved_tokens = self.rate_limiter.acquire(
+                model_used, self.rate_limiter.estimate_tokens(system_prompt, request_text)
+            )
+            used_tokens = None
             try:
                 logger.debug(f"Open AI call attempt: {attempt}")
-                response = self.openai_client.chat.completions.create(
+                raw_response = self.openai_client.chat.completions.with_raw_response.create(
                     model=model_used,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {"role": "user", "content": request_text}
                     ],
-                    temperature=JBGAnnualReportAnalyzer.get_permitted_temperature(model_used),
-                    top_p=self.DEFAULT_OPENAI_TOP_P
+                    temperature=temperature,
+                    top_p=self.DEFAULT_OPENAI_TOP_P,
+                    **extra_parameters
                 )
+                self.rate_limiter.update_from_headers(model_used, raw_response.headers)
+                response = raw_response.parse()
 
                 # Tokenkontroll
                 usage = getattr(response, "usage", None)
                 if usage:
                     total_tokens = usage.total_tokens or 0
+                    used_tokens = total_tokens
+                    self._record_prompt_token_usage(usage)
                     token_limit = MODEL_TOKEN_LIMITS.get(model_used, 8192)
                     if total_tokens >= token_limit:
                         logging.warning(
@@ -506,9 +891,24 @@ class JBGAnnualReportAnalyzer:
                     )
 
                 logger.debug(f"GPT-response:\n{response}")
-                return response.choices[0].message.content.strip()
-
-            except (RateLimitError, Timeout, APIError) as ex:
+                message = response.choices[0].message
+                if getattr(message, "refusal", None) or message.content is None:
+                    raise RuntimeError(f"GPT vägrade svara: {getattr(message, 'refusal', None)}")
+                content = message.content.strip()
+                if cache_key:
+                    self.response_cache.put(cache_key, content)
+                return content
+
+            except RateLimitError as ex:
+                retry_after = RateLimiter.retry_after_seconds(getattr(ex.response, "headers", None))
+                delay = retry_after if retry_after is not None else initial_delay * (backoff_factor ** attempt)
+                logger.warning(f"OpenAI API-fel (försök {attempt+1}/{max_retries}): {ex}. Försöker igen om {delay:.1f}s.")
+                self.rate_limiter.pause(model_used, delay)
+                attempt += 1
+            except BadRequestError:
+                # Samma anrop ger samma fel igen, t.ex. för lång kontext eller ogiltigt schema
+                raise
+            except (APITimeoutError, APIError) as ex:
                 delay = initial_delay * (backoff_factor ** attempt)
                 logger.warning(f"OpenAI API-fel (försök {attempt+1}/{max_retries}): {ex}. Försöker igen om {delay:.1f}s.")
                 time.sleep(delay)
@@ -516,9 +916,186 @@ class JBGAnnualReportAnalyzer:
             except Exception as ex:
                 logger.error(f"Allvarligt fel i OpenAI-anrop: {ex}")
                 break
+            finally:
+                self.rate_limiter.record_usage(model_used, reserved_tokens, used_tokens)
+
+        raise RuntimeError("Maximalt antal försök för API-anropet överskreds.")
+
+    @staticmethod
+    def _is_streaming_rejected(ex: APIError) -> bool:
+        """
+        Sant om felet gäller själva strömningen, t.ex. en modell som inte får strömmas
+        utan verifierad organisation, och inte förfrågan i övrigt.
+        """
+        param = getattr(ex, "param", None)
+        if param in ("stream", "stream_options"):
+            return True
+        code = getattr(ex, "code", None)
+        return code in ("unsupported_parameter", "unsupported_value") and "stream" in str(getattr(ex, "message", ex)).lower()
+
+    def _make_streaming_openai_api_call(
+        self, system_prompt, request_text: str, model: str = "", response_format: dict = None, create_parser=None
+    ) -> tuple:
+        """
+        Som _make_openai_api_call men tar emot svaret som en ström. Varje del matas till en
+        parser från create_parser så att färdiga nyckeltal kan tas om hand direkt, och läsningen
+        avbryts så snart JSON-svaret är komplett. Returnerar (innehåll, finish_reason, parser);
+        ett trunkerat svar returneras i stället för att kastas bort.
+        """
+        model_used = model if model else self.DEFAULT_MODEL
+        temperature = JBGAnnualReportAnalyzer.get_permitted_temperature(model_used)
+
+        cache_key = None
+        if self.response_cache:
+            cache_key = ResponseCache.make_key(model_used, temperature, system_prompt, request_text, response_format)
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug(f"Using cached GPT response for key {cache_key}")
+                parser = create_parser() if create_parser else None
+                if parser:
+                    self._feed_parser(parser, cached_response)
+                return cached_response, "stop", parser
+
+        max_retries = 5
+        initial_delay = 1.5
+        backoff_factor = 2.0
+        attempt = 0
+        extra_parameters = {"response_format": response_format} if response_format else {}
+
+        while attempt < max_retries:
+            reserved_tokens = self.rate_limiter.acquire(
+                model_used, self.rate_limiter.estimate_tokens(system_prompt, request_text)
+            )
+            used_tokens = None
+            parser = create_parser() if create_parser else None
+            try:
+                logger.debug(f"Open AI streaming call attempt: {attempt}")
+                raw_response = self.openai_client.chat.completions.with_raw_response.create(
+                    model=model_used,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": request_text}
+                    ],
+                    temperature=temperature,
+                    top_p=self.DEFAULT_OPENAI_TOP_P,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **extra_parameters
+                )
+                self.rate_limiter.update_from_headers(model_used, raw_response.headers)
+                stream = raw_response.parse()
+
+                parts = []
+                finish_reason = None
+                try:
+                    for event in stream:
+                        usage = getattr(event, "usage", None)
+                        if usage:
+                            used_tokens = usage.total_tokens or 0
+                            self._record_prompt_token_usage(usage)
+                        if not event.choices:
+                            continue
+                        choice = event.choices[0]
+                        delta = getattr(choice.delta, "content", None)
+                        if getattr(choice.delta, "refusal", None):
+                            raise RuntimeError(f"GPT vägrade svara: {choice.delta.refusal}")
+                        if delta:
+                            parts.append(delta)
+                            if parser and not self._feed_parser(parser, delta):
+                                # Resten kan inte tolkas; behåll de nyckeltal som redan lästs in
+                                finish_reason = self.FINISH_REASON_INVALID_JSON
+                                break
+                        if choice.finish_reason:
+                            finish_reason = choice.finish_reason
+                        if parser and parser.complete and finish_reason is None:
+                            # Resten av svaret kan inte tillföra något – sluta läsa
+                            logger.debug("JSON-svaret är komplett, avbryter strömmen.")
+                            finish_reason = "stop"
+                            break
+                finally:
+                    stream.close()
+
+                content = "".join(parts).strip()
+                if finish_reason != "stop":
+                    logger.warning(
+                        f"GPT-svar avslutades med '{finish_reason}' – behåller det som hann tas emot ({len(content)} tecken)."
+                    )
+                elif cache_key:
+                    self.response_cache.put(cache_key, content)
+                return content, finish_reason, parser
+
+            except (BadRequestError, PermissionDeniedError) as ex:
+                if not self._is_streaming_rejected(ex):
+                    raise
+                # T.ex. modeller som inte får strömmas utan verifierad organisation
+                logger.warning(f"Strömmande anrop nekades ({ex}). Använder vanliga anrop i fortsättningen.")
+                self.use_streaming = False
+                content = self._make_openai_api_call(system_prompt, request_text, model, response_format)
+                parser = create_parser() if create_parser else None
+                if parser:
+                    self._feed_parser(parser, content)
+                return content, "stop", parser
+            except RateLimitError as ex:
+                retry_after = RateLimiter.retry_after_seconds(getattr(ex.response, "headers", None))
+                delay = retry_after if retry_after is not None else initial_delay * (backoff_factor ** attempt)
+                logger.warning(f"OpenAI API-fel (försök {attempt+1}/{max_retries}): {ex}. Försöker igen om {delay:.1f}s.")
+                self.rate_limiter.pause(model_used, delay)
+                attempt += 1
+            except (APITimeoutError, APIError) as ex:
+                delay = initial_delay * (backoff_factor ** attempt)
+                logger.warning(f"OpenAI API-fel (försök {attempt+1}/{max_retries}): {ex}. Försöker igen om {delay:.1f}s.")
+                time.sleep(delay)
+                attempt += 1
+            except Exception as ex:
+                # Ett nytt försök hjälper inte, och felet ska inte se ut som uttömda försök
+                logger.error(f"Allvarligt fel i OpenAI-anrop: {ex}")
+                raise
+            finally:
+                self.rate_limiter.record_usage(model_used, reserved_tokens, used_tokens)
 
         raise RuntimeError("Maximalt antal försök för API-anropet överskreds.")
 
+    @staticmethod
+    def _feed_parser(parser, text: str) -> bool:
+        """
+        Matar parsern med text. Returnerar False om texten inte går att tolka som JSON;
+        nyckeltal som parsern redan tagit emot finns kvar i parser.result().
+        """
+        try:
+            parser.feed(text)
+            return True
+        except ValueError as e:
+            logger.warning(f"Ogiltig JSON i GPT-svaret: {e}")
+            return False
+
+    def _create_response_parser(self, response_schema: ResponseSchema = None):
+        response_schema = response_schema if response_schema else self.response_schema
+        if response_schema:
+            return response_schema.create_parser(on_metric=self._log_received_metric)
+        return FreeformResponseParser(on_metric=self._log_received_metric)
+
+    def _log_received_metric(self, fund_name: str, year: str, metric_name: str, value: dict):
+        # Dokumentets resultat byggs av chunkarnas parser.result(); här syns bara nyckeltalen när de kommer
+        logger.info(f"Nyckeltal mottaget: {fund_name} / {year} / {metric_name} = {value.get(self.FIELD_VALUE)}")
+
+    def _record_prompt_token_usage(self, usage):
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+        with self._prompt_token_usage_lock:
+            self.prompt_token_usage["prompt_tokens"] += prompt_tokens
+            self.prompt_token_usage["cached_tokens"] += cached_tokens
+        logger.debug(f"Prompt tokens: {prompt_tokens}, varav cachade: {cached_tokens}")
+
+    def _log_prompt_cache_hit_rate(self):
+        prompt_tokens = self.prompt_token_usage["prompt_tokens"]
+        cached_tokens = self.prompt_token_usage["cached_tokens"]
+        if prompt_tokens:
+            logger.info(
+                f"Prompt cache: {cached_tokens} av {prompt_tokens} prompt-tokens cachade "
+                f"({round(100.0 * cached_tokens / prompt_tokens, 1)} %)"
+            )
+
     def _clean_presumed_prefixed_json(self, presumed_prefixed_json):
         if presumed_prefixed_json.startswith("```json"):
             presumed_prefixed_json = presumed_prefixed_json.removeprefix("```json").strip()
@@ -761,122 +1338,52 @@ class JBGAnnualReportAnalyzer:
 
         total_result = []
 
-        first_openai_call = True
-        
-        # We loop over all the pdf files
-        for _pdf_path in self.upload_files:
-            logger.info(f"Processar fil: {_pdf_path}")
-            
-            # Use masking if required
-            if self.use_masking:
-                masker = PDFMasker()
-                pdf_output_path = Path(_pdf_path.with_name(_pdf_path.stem + "_masked.pdf"))
-                pdf_path = masker.do_masking(_pdf_path, pdf_output_path, logger=logger)
-                
-                if pdf_path is None:
-                    logger.error(f"Maskering misslyckades för fil: {_pdf_path.name}. Hoppar över denna fil i analysen.")
-                    continue
-            else:
-                pdf_path = _pdf_path
-
-            # Get the current year for the analysis
-            try:
-                the_year = self._find_primary_year_from_pdf(pdf_path)
-                logger.info(f"Extraherade aktuellt år från: {pdf_path.name} som: {the_year}")
-                if the_year < 0:
-                    raise RuntimeError(f"Could not extract main year from {pdf_path} to be used in system prompt.")
-            except RuntimeError as ex:
-                logger.warning(f"{str(ex)}. Setting year unknown.")
-                the_year = None
-            
-            # Get the full text of the pdf
-            logger.info(f"Extraherar text från: {pdf_path.name}")
-            try:
-                full_text = self._extract_text_from_pdf_from_pdf(pdf_path)
-                #logger.debug(f"The full text for {pdf_path} is: {full_text}")
-            except FileTypeException:
-                logger.warning(f"Skipping file {pdf_path} since I could not extract any text from it (perhaps it was scanned?)")
-                continue
-            
-            # Try to fix broken lines that can contain key numbers and values
-            if self.FIX_BROKEN_LINES_WITH_KEY_NUMBERS:
-                try:
-                    full_text = self._merge_broken_key_number_lines(full_text, self._extract_key_number_terms())
-                    logger.debug(f"The full text for {pdf_path} where broken lines with key numbers are merged is: {full_text}")
-                except Exception as ex:
-                    logger.warning(f"Could not merge broken lines with key numbers and data in for full text of file: {pdf_path}")
-            
-            # Divide the text into chunks with or without overlap
-            if self.USE_TOKEN_OVERLAP:
-                chunks = self._chunk_text_with_overlap(
-                    text=full_text, max_tokens=self.MAX_TOKENS, max_overlap_tokens=self.MAX_TOKEN_OVERLAP, model=model
-                    )
-            else:
-                chunks = self._chunk_text(full_text, max_tokens=self.MAX_TOKENS, model=model)
-            logger.info(f"{len(chunks)} chunk(s) genererade för {pdf_path.name}")
-            
-            # Loop over the chunks
-            partial_results = []
-            for i, chunk in enumerate(chunks):
-                
-                # Build the system prompt instructions
-                prompt = self._build_system_prompt(the_year=the_year)
-                logger.debug(f"Prompt {i}: {prompt}")
-                
-                # Build the prompt request, make API call and collect results
-                request = self._build_request_text(chunk)
-                logger.debug(f"Request {i}: {request}")
-                try:
-                    if first_openai_call:
-                        first_openai_call = False
-                    else:
-                        time.sleep(self.DEFAULT_LONG_SLEEP_TIME)
-                    logger.info(f"Skickar chunk {i+1}/{len(chunks)} till GPT...")
-                    response = self._make_openai_api_call(prompt, request, model)
-                    logger.debug(f"GPT-rådata:\n{response}")
-                    
-                    # Hantera JSON-data som kommer tillbaka från GPT-anropet
-                    response_cleaned = self._clean_presumed_prefixed_json(response).strip()
-
-                    # Kontrollera att svaret åtminstone ser ut som JSON
-                    if not response_cleaned.startswith("{") or not response_cleaned.endswith("}"):
-                        logger.warning("GPT-svar representerar inte giltig JSON-kod – hoppar över detta chunk.")
-                        continue
+        # Use masking if required
+        pdf_paths = []
+        # The masker keeps its worker processes, and their NER models, for all the files
+        masker = PDFMasker() if self.use_masking else None
+        try:
+            for _pdf_path in self.upload_files:
+                if self.use_masking:
+                    pdf_output_path = Path(_pdf_path.with_name(_pdf_path.stem + "_masked.pdf"))
+                    pdf_path = masker.do_masking(_pdf_path, pdf_output_path, logger=logger)
 
-                    # Försök att ladda in JSON strukturen
-                    try:
-                        response_json = json.loads(response_cleaned)
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Misslyckades att parsa JSON: {e} – hoppar över detta chunk.")
+                    if pdf_path is None:
+                        logger.error(f"Maskering misslyckades för fil: {_pdf_path.name}. Hoppar över denna fil i analysen.")
                         continue
+                else:
+                    pdf_path = _pdf_path
+                pdf_paths.append(Path(pdf_path))
+        finally:
+            if masker:
+                masker.close()
+
+        # OCR all documents that need it in parallel before the analysis
+        self._prefetch_ocr(pdf_paths)
+        
+        # Prepare the chunks and prompts of every document
+        documents = []
+        for pdf_path in pdf_paths:
+            prepared = self._prepare_document_chunks(pdf_path, model)
+            if prepared is not None:
+                documents.append(prepared)
+
+        # Send the chunks to GPT, either all together through the Batch API or per document
+        if self.execution_mode == self.EXECUTION_MODE_BATCH:
+            results_per_document = self._analyze_documents_in_batch(documents, model)
+        else:
+            results_per_document = []
+            for _, the_year, chunks, prompts, schemas in documents:
+                results_per_document.append(self._analyze_document_chunks(chunks, prompts, model, the_year, schemas))
 
-                    # Kontroll att innehållet tillför något, annars hoppa över
-                    non_null_count = self._count_non_null_metrics(response_json)
-                    if non_null_count == 0:
-                        logger.info(f"Skipping chunk due to low data extraction: {non_null_count} metrics found.")
-                        continue
-                    partial_results.append(response_json)
-                except Exception as e:
-                    logger.error(f"Fel vid GPT-anrop chunk {i+1}: {e}")
-                    continue
-            
-            # Put together and clean up the result
-            appended_result = self._deep_merge_json_objects(partial_results)
-            logger.debug(f"In do_analysis: partial_results:")
-            for result in partial_results:
-                logger.debug(f"{result}")
-            logger.debug(f"In do_analysis: appended_result: {appended_result}")
+        # Put together and clean up the result
+        for partial_results in results_per_document:
+            appended_result = self._merge_partial_results(partial_results)
             if appended_result:
-                appended_result, conflicts = self._merge_json_fund_data(appended_result)
-                if conflicts:
-                    logger.warning(f"Last merge of JSON data resulted in {len(conflicts)} conflicts: {conflicts}")
-                    appended_result, num_merged_values = self._merge_conflicted_values_json_objects(appended_result)
-                    if num_merged_values > 0:
-                        logger.info(f"Merged {num_merged_values} duplicate values in appended JSON structure")
-                    else:
-                        logger.warning(f"No conclicts were merged.")
                 total_result.append(appended_result)
 
+        self._log_prompt_cache_hit_rate()
+
         # Write result to JSON output
         if total_result:
             final_result = self._deep_merge_json_objects(total_result)
@@ -887,6 +1394,248 @@ class JBGAnnualReportAnalyzer:
             logger.warning(f"Inga resultat sparades.")
             return None
     
+    def _prepare_document_chunks(self, pdf_path: Path, model: str) -> Optional[tuple]:
+        """
+        Returns (pdf_path, the_year, chunks, prompts, schemas) for a document, or None if no text could be extracted.
+        schemas holds the response schema of each chunk (None without JSON schema).
+        """
+        logger.info(f"Processar fil: {pdf_path}")
+
+        # Get the current year for the analysis
+        try:
+            the_year = self._find_primary_year_from_pdf(pdf_path)
+            logger.info(f"Extraherade aktuellt år från: {pdf_path.name} som: {the_year}")
+            if the_year < 0:
+                raise RuntimeError(f"Could not extract main year from {pdf_path} to be used in system prompt.")
+        except RuntimeError as ex:
+            logger.warning(f"{str(ex)}. Setting year unknown.")
+            the_year = None
+
+        # Get the full text of the pdf
+        logger.info(f"Extraherar text från: {pdf_path.name}")
+        try:
+            full_text = self._extract_text_from_pdf_from_pdf(pdf_path)
+            #logger.debug(f"The full text for {pdf_path} is: {full_text}")
+        except FileTypeException:
+            logger.warning(f"Skipping file {pdf_path} since I could not extract any text from it (perhaps it was scanned?)")
+            return None
+
+        # Try to fix broken lines that can contain key numbers and values
+        if self.FIX_BROKEN_LINES_WITH_KEY_NUMBERS:
+            try:
+                full_text = self._merge_broken_key_number_lines(full_text, self._extract_key_number_terms())
+                logger.debug(f"The full text for {pdf_path} where broken lines with key numbers are merged is: {full_text}")
+            except Exception as ex:
+                logger.warning(f"Could not merge broken lines with key numbers and data in for full text of file: {pdf_path}")
+
+        if self.extraction_mode == self.EXTRACTION_MODE_TARGETED:
+            # Send each group of metrics only the pages where they occur
+            chunks, prompts, schemas = self._build_targeted_chunks(full_text, the_year, model)
+        else:
+            # Only keep pages that are likely to contain key numbers
+            if self.USE_RELEVANCE_FILTER:
+                try:
+                    full_text = self._filter_relevant_pages(full_text)
+                except Exception as ex:
+                    logger.warning(f"Could not filter relevant pages of {pdf_path.name}: {ex}. Using all pages.")
+
+            # Divide the text into chunks by sections, or with or without overlap
+            if self.USE_STRUCTURE_AWARE_CHUNKING:
+                chunks = self._chunk_text_by_sections(
+                    text=full_text, max_tokens=self.MAX_TOKENS, max_overlap_tokens=self.MAX_TOKEN_OVERLAP, model=model
+                    )
+            elif self.USE_TOKEN_OVERLAP:
+                chunks = self._chunk_text_with_overlap(
+                    text=full_text, max_tokens=self.MAX_TOKENS, max_overlap_tokens=self.MAX_TOKEN_OVERLAP, model=model
+                    )
+            else:
+                chunks = self._chunk_text(full_text, max_tokens=self.MAX_TOKENS, model=model)
+            prompts = [self._build_system_prompt(the_year=the_year)] * len(chunks)
+            schemas = [self.response_schema] * len(chunks)
+        logger.info(f"{len(chunks)} chunk(s) genererade för {pdf_path.name}")
+        return pdf_path, the_year, chunks, prompts, schemas
+
+    def _analyze_document_chunks(
+        self, chunks: List[str], prompts: List[str], model: str, the_year: int = None, schemas: list = None
+    ) -> List[dict]:
+        schemas = schemas if schemas else [self.response_schema] * len(chunks)
+        if self.max_concurrent_chunks > 1 and len(chunks) > 1:
+            return self._analyze_chunks_concurrently(chunks, prompts, model, the_year, schemas)
+        partial_results = []
+        for i, (chunk, prompt, schema) in enumerate(zip(chunks, prompts, schemas)):
+            response_json = self._analyze_chunk(i, chunk, len(chunks), prompt, model, the_year, schema)
+            if response_json is not None:
+                partial_results.append(response_json)
+        return partial_results
+
+    def _analyze_documents_in_batch(self, documents: List[tuple], model: str) -> List[List[dict]]:
+        """
+        Sends the chunks of all documents as one job through the OpenAI Batch API and
+        returns the parsed chunk results per document, in document and chunk order.
+        Chunks with a cached response are not sent again.
+        """
+        model_used = model if model else self.DEFAULT_MODEL
+        temperature = JBGAnnualReportAnalyzer.get_permitted_temperature(model_used)
+
+        responses, batch_requests, cache_keys = {}, [], {}
+        for doc_index, (_, the_year, chunks, prompts, schemas) in enumerate(documents):
+            for i, (chunk, prompt, schema) in enumerate(zip(chunks, prompts, schemas)):
+                custom_id = f"{doc_index}-{i}"
+                request = self._build_request_text(chunk, the_year=the_year)
+                response_format = self._get_response_format_parameter(schema)
+                if self.response_cache:
+                    cache_keys[custom_id] = ResponseCache.make_key(
+                        model_used, temperature, prompt, request, response_format
+                    )
+                    cached_response = self.response_cache.get(cache_keys[custom_id])
+                    if cached_response is not None:
+                        responses[custom_id] = cached_response
+                        continue
+                parameters = {"temperature": temperature, "top_p": self.DEFAULT_OPENAI_TOP_P}
+                if response_format:
+                    parameters["response_format"] = response_format
+                batch_requests.append(BatchRunner.make_request(custom_id, model_used, prompt, request, **parameters))
+
+        logger.info(f"{len(responses)} chunk(s) hämtade från cachen, {len(batch_requests)} skickas via Batch API")
+        if batch_requests:
+            work_dir = (self.cache_dir / "batches") if self.cache_dir else (documents[0][0].parent / "batches")
+            runner = BatchRunner(self.openai_client, work_dir, poll_interval=self.BATCH_POLL_INTERVAL)
+            batch_responses = runner.run(batch_requests, name=f"analysis_{int(time.time())}")
+            for custom_id, content in batch_responses.items():
+                if custom_id in cache_keys:
+                    self.response_cache.put(cache_keys[custom_id], content)
+            responses.update(batch_responses)
+
+        results_per_document = []
+        for doc_index, (_, _, chunks, _, schemas) in enumerate(documents):
+            partial_results = []
+            for i, schema in enumerate(schemas):
+                response = responses.get(f"{doc_index}-{i}")
+                if response is None:
+                    logger.warning(f"Inget svar för chunk {i+1}/{len(chunks)} i dokument {doc_index+1} – hoppar över detta chunk.")
+                    continue
+                response_json = self._parse_chunk_response(response, schema)
+                if response_json is not None:
+                    partial_results.append(response_json)
+            results_per_document.append(partial_results)
+        return results_per_document
+
+    def _merge_partial_results(self, partial_results: List[dict]) -> Optional[dict]:
+        appended_result = self._deep_merge_json_objects(partial_results)
+        logger.debug(f"In do_analysis: partial_results:")
+        for result in partial_results:
+            logger.debug(f"{result}")
+        logger.debug(f"In do_analysis: appended_result: {appended_result}")
+        if appended_result:
+            appended_result, conflicts = self._merge_json_fund_data(appended_result)
+            if conflicts:
+                logger.warning(f"Last merge of JSON data resulted in {len(conflicts)} conflicts: {conflicts}")
+                appended_result, num_merged_values = self._merge_conflicted_values_json_objects(appended_result)
+                if num_merged_values > 0:
+                    logger.info(f"Merged {num_merged_values} duplicate values in appended JSON structure")
+                else:
+                    logger.warning(f"No conclicts were merged.")
+        return appended_result
+
+    def _analyze_chunk(
+        self, i: int, chunk: str, num_chunks: int, prompt: str, model: str, the_year: int = None,
+        response_schema: ResponseSchema = None
+    ) -> Optional[dict]:
+        
+        logger.debug(f"Prompt {i}: {prompt}")
+        
+        # Build the prompt request, make API call and collect results
+        request = self._build_request_text(chunk, the_year=the_year)
+        logger.debug(f"Request {i}: {request}")
+        try:
+            logger.info(f"Skickar chunk {i+1}/{num_chunks} till GPT...")
+            response_format = self._get_response_format_parameter(response_schema)
+            if not self.use_streaming:
+                response = self._make_openai_api_call(prompt, request, model, response_format)
+                return self._parse_chunk_response(response, response_schema)
+
+            response, finish_reason, parser = self._make_streaming_openai_api_call(
+                prompt, request, model, response_format, lambda: self._create_response_parser(response_schema)
+            )
+            if finish_reason == "stop":
+                return self._parse_chunk_response(response, response_schema)
+
+            # Trunkerat eller ogiltigt svar: behåll de nyckeltal som hann bli kompletta
+            if parser.num_metrics == 0:
+                logger.info(f"Skipping incomplete chunk {i+1} ({finish_reason}): no complete metrics received.")
+                return None
+            logger.info(f"Behåller {parser.num_metrics} kompletta nyckeltal från ofullständigt svar ({finish_reason}) för chunk {i+1}.")
+            return parser.result()
+        except Exception as e:
+            logger.error(f"Fel vid GPT-anrop chunk {i+1}: {e}")
+            return None
+
+    def _parse_chunk_response(self, response: str, response_schema: ResponseSchema = None) -> Optional[dict]:
+        logger.debug(f"GPT-rådata:\n{response}")
+        response_schema = response_schema if response_schema else self.response_schema
+        if response_schema:
+            return self._parse_structured_chunk_response(response, response_schema)
+
+        # Hantera JSON-data som kommer tillbaka från GPT-anropet
+        response_cleaned = self._clean_presumed_prefixed_json(response).strip()
+
+        # Kontrollera att svaret åtminstone ser ut som JSON
+        if not response_cleaned.startswith("{") or not response_cleaned.endswith("}"):
+            logger.warning("GPT-svar representerar inte giltig JSON-kod – hoppar över detta chunk.")
+            return None
+
+        # Försök att ladda in JSON strukturen
+        try:
+            response_json = json.loads(response_cleaned)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Misslyckades att parsa JSON: {e} – hoppar över detta chunk.")
+            return None
+
+        # Kontroll att innehållet tillför något, annars hoppa över
+        non_null_count = self._count_non_null_metrics(response_json)
+        if non_null_count == 0:
+            logger.info(f"Skipping chunk due to low data extraction: {non_null_count} metrics found.")
+            return None
+        return response_json
+
+    def _analyze_chunks_concurrently(
+        self, chunks: List[str], prompts: List[str], model: str, the_year: int = None, schemas: list = None
+    ) -> List[dict]:
+        """
+        Skickar alla chunks parallellt till GPT med högst max_concurrent_chunks anrop i luften.
+        Resultaten returneras i samma ordning som chunkarna så att sammanslagningen blir
+        densamma som i den sekventiella körningen.
+        """
+        schemas = schemas if schemas else [self.response_schema] * len(chunks)
+        num_workers = min(self.max_concurrent_chunks, len(chunks))
+        logger.info(f"Skickar {len(chunks)} chunk(s) till GPT med {num_workers} parallella anrop")
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(self._analyze_chunk, i, chunk, len(chunks), prompt, model, the_year, schema)
+                for i, (chunk, prompt, schema) in enumerate(zip(chunks, prompts, schemas))
+            ]
+            results = [future.result() for future in futures]
+        return [result for result in results if result is not None]
+
+    def _parse_structured_chunk_response(self, response: str, response_schema: ResponseSchema = None) -> Optional[dict]:
+        """
+        Tolkar ett svar som följer JSON-schemat och gör om det till strukturen a-kassa -> år -> nyckeltal.
+        Varje nyckeltal valideras när det är färdigläst; ogiltiga värden hoppas över.
+        """
+        parser = (response_schema if response_schema else self.response_schema).create_parser()
+        try:
+            parser.feed(self._clean_presumed_prefixed_json(response.strip()))
+        except ValueError as e:
+            logger.warning(f"Misslyckades att parsa JSON: {e} – använder de nyckeltal som hann läsas in.")
+        if not parser.complete:
+            logger.warning("GPT-svaret enligt JSON-schemat är ofullständigt – använder de nyckeltal som hann läsas in.")
+        if parser.num_rejected:
+            logger.warning(f"{parser.num_rejected} nyckeltal med ogiltiga värden hoppades över.")
+        if parser.num_metrics == 0:
+            logger.info(f"Skipping chunk due to low data extraction: 0 metrics found.")
+            return None
+        return parser.result()
+
     def _count_non_null_metrics(self, json_obj: dict) -> int:
         count = 0
         for fund, years in json_obj.items():
@@ -5,5 +5,10 @@ class FileTypeException(BaseException):
         
 class EmptyOutputException(BaseException):
     def __init__(self, message="Tomt utdata"):
+        self.message = message
+        super().__init__(self.message)
+
+class MaskingException(BaseException):
+    def __init__(self, message="Maskeringen misslyckades"):
         self.message = message
         super().__init__(self.message)
\ No newline at end of file
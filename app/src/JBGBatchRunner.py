@@ -0,0 +1,139 @@
+import io
+import json
+import time
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRunner:
+    """
+    Runs chat completion requests through the OpenAI Batch API.
+
+    The requests are written to a JSONL file, uploaded and submitted as one or more
+    batches, which are polled until they are done. The results are returned as a
+    mapping from custom_id to the response message content. Requests that failed or
+    did not finish within the completion window are missing from the result.
+    """
+    ENDPOINT = "/v1/chat/completions"
+    COMPLETION_WINDOW = "24h"
+    FILE_PURPOSE = "batch"
+    MAX_REQUESTS_PER_BATCH = 50000
+    DEFAULT_POLL_INTERVAL = 30.0
+    DEFAULT_TIMEOUT = 26 * 60 * 60
+    PENDING_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+    STANDARD_ENCODING = "utf-8"
+
+    def __init__(
+        self,
+        client,
+        work_dir: Union[str, Path],
+        poll_interval: float = None,
+        timeout: float = None
+    ):
+        self.client = client
+        self.work_dir = Path(work_dir)
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.poll_interval = poll_interval if poll_interval else self.DEFAULT_POLL_INTERVAL
+        self.timeout = timeout if timeout else self.DEFAULT_TIMEOUT
+
+    @classmethod
+    def make_request(cls, custom_id: str, model: str, system_prompt: str, request_text: str, **params) -> dict:
+        body = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": request_text}
+            ]
+        }
+        body.update(params)
+        return {"custom_id": custom_id, "method": "POST", "url": cls.ENDPOINT, "body": body}
+
+    def write_requests(self, requests: List[dict], path: Union[str, Path]) -> Path:
+        path = Path(path)
+        with path.open("w", encoding=self.STANDARD_ENCODING) as f:
+            for request in requests:
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+        return path
+
+    def submit(self, input_path: Union[str, Path], metadata: dict = None) -> str:
+        with Path(input_path).open("rb") as f:
+            input_file = self.client.files.create(file=f, purpose=self.FILE_PURPOSE)
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=self.ENDPOINT,
+            completion_window=self.COMPLETION_WINDOW,
+            metadata=metadata
+        )
+        logger.info(f"Submitted batch {batch.id} with input file {input_file.id}")
+        return batch.id
+
+    def wait(self, batch_id: str):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            counts = getattr(batch, "request_counts", None)
+            if counts:
+                logger.info(
+                    f"Batch {batch_id}: {batch.status} "
+                    f"({counts.completed}/{counts.total} klara, {counts.failed} misslyckade)"
+                )
+            else:
+                logger.info(f"Batch {batch_id}: {batch.status}")
+            if batch.status not in self.PENDING_STATUSES:
+                return batch
+            if time.monotonic() >= deadline:
+                logger.warning(f"Batch {batch_id} did not finish in {self.timeout}s, cancelling it")
+                self.client.batches.cancel(batch_id)
+                deadline = float("inf")
+            time.sleep(self.poll_interval)
+
+    def _read_file(self, file_id: str) -> str:
+        content = self.client.files.content(file_id)
+        return content.text
+
+    def download_results(self, batch) -> Dict[str, Optional[str]]:
+        results = {}
+        if batch.status != "completed":
+            logger.warning(f"Batch {batch.id} ended with status '{batch.status}'")
+
+        if getattr(batch, "error_file_id", None):
+            for line in io.StringIO(self._read_file(batch.error_file_id)):
+                if line.strip():
+                    record = json.loads(line)
+                    logger.warning(f"Batch request {record.get('custom_id')} failed: {record.get('error') or record.get('response')}")
+
+        if not getattr(batch, "output_file_id", None):
+            return results
+        for line in io.StringIO(self._read_file(batch.output_file_id)):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            custom_id = record.get("custom_id")
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                logger.warning(f"Batch request {custom_id} failed: {record.get('error') or response.get('status_code')}")
+                continue
+            choice = response["body"]["choices"][0]
+            if choice.get("finish_reason") != "stop":
+                logger.warning(f"Batch request {custom_id} avslutades med '{choice.get('finish_reason')}' – hoppar över.")
+                continue
+            results[custom_id] = (choice["message"].get("content") or "").strip()
+        return results
+
+    def run(self, requests: List[dict], name: str = "batch") -> Dict[str, Optional[str]]:
+        """
+        Submits all requests, waits for every batch and returns the collected results.
+        """
+        batch_ids = []
+        for start in range(0, len(requests), self.MAX_REQUESTS_PER_BATCH):
+            part = requests[start:start + self.MAX_REQUESTS_PER_BATCH]
+            input_path = self.write_requests(part, self.work_dir / f"{name}_{len(batch_ids)}.jsonl")
+            batch_ids.append(self.submit(input_path, metadata={"name": name}))
+
+        results = {}
+        for batch_id in batch_ids:
+            results.update(self.download_results(self.wait(batch_id)))
+        return results
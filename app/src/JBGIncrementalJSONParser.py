@@ -0,0 +1,176 @@
+import json
+import logging
+from bisect import bisect_right
+from typing import Any, Callable, List, Optional, Set, Union
+
+logger = logging.getLogger(__name__)
+
+PathElement = Union[str, int]
+
+
+class IncrementalJSONError(ValueError):
+    """
+    Raised when the fed text cannot be the beginning of a JSON document.
+    """
+
+
+class _Frame:
+    __slots__ = ("kind", "start", "key", "index", "expecting_key")
+
+    def __init__(self, kind: str, start: int):
+        self.kind = kind
+        self.start = start
+        self.key = None
+        self.index = 0
+        self.expecting_key = kind == "{"
+
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON document that arrives in pieces, e.g. from a streamed response.
+
+    Text is fed with feed() as it arrives. Every value is reported to on_value
+    together with its path from the root (object keys and array indices) as soon as
+    the value is complete, so the caller can validate and keep finished parts before
+    the whole document has arrived. With emit_depths only values at those path
+    lengths are reported, which avoids decoding large containers more than once.
+
+    The pieces are kept as they arrive and only the new piece is scanned, so feeding
+    a long stream in small deltas takes linear time. Text that breaks the structure,
+    like a closing bracket without an opening one, raises IncrementalJSONError;
+    values reported before that are unaffected.
+    """
+    _WHITESPACE = " \t\r\n"
+    _SCALAR_END = " \t\r\n,]}"
+
+    def __init__(
+        self,
+        on_value: Callable[[List[PathElement], Any], None] = None,
+        emit_depths: Optional[Set[int]] = None
+    ):
+        self.on_value = on_value
+        self.emit_depths = emit_depths
+        self._pieces: List[str] = []
+        self._piece_starts: List[int] = []
+        self._length = 0
+        self._stack: List[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        self._token_start = None
+        self.complete = False
+
+    @property
+    def text(self) -> str:
+        if len(self._pieces) > 1:
+            self._pieces = ["".join(self._pieces)]
+            self._piece_starts = [0]
+        return self._pieces[0] if self._pieces else ""
+
+    def _slice(self, start: int, end: int) -> str:
+        """
+        Returns the fed text between the absolute positions start and end.
+        """
+        i = bisect_right(self._piece_starts, start) - 1
+        parts = []
+        while i < len(self._pieces) and self._piece_starts[i] < end:
+            piece_start = self._piece_starts[i]
+            parts.append(self._pieces[i][max(start - piece_start, 0):end - piece_start])
+            i += 1
+        return "".join(parts)
+
+    def _path(self) -> List[PathElement]:
+        return [frame.key if frame.kind == "{" else frame.index for frame in self._stack]
+
+    def _emit(self, start: int, end: int):
+        if self.on_value is None:
+            return
+        path = self._path()
+        if self.emit_depths is not None and len(path) not in self.emit_depths:
+            return
+        self.on_value(path, self._decode(start, end))
+
+    def _decode(self, start: int, end: int) -> Any:
+        text = self._slice(start, end)
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise IncrementalJSONError(f"Invalid JSON value {text[:40]!r} at position {start}: {e}") from e
+
+    def _end_scalar(self, end: int):
+        self._emit(self._token_start, end)
+        self._token_start = None
+        if not self._stack:
+            self.complete = True
+
+    def _current_frame(self, c: str, pos: int) -> _Frame:
+        if not self._stack:
+            raise IncrementalJSONError(f"Unexpected '{c}' outside of an object or array at position {pos}")
+        return self._stack[-1]
+
+    def feed(self, text: str):
+        if self.complete or not text:
+            return
+        offset = self._length
+        self._piece_starts.append(offset)
+        self._pieces.append(text)
+        self._length += len(text)
+        for i, c in enumerate(text):
+            pos = offset + i
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    frame = self._stack[-1] if self._stack else None
+                    if frame is not None and frame.kind == "{" and frame.expecting_key:
+                        frame.key = self._decode(self._token_start, pos + 1)
+                        self._token_start = None
+                    else:
+                        self._end_scalar(pos + 1)
+                continue
+
+            if self._token_start is not None:
+                # Inside a number or a literal (true, false, null)
+                if c not in self._SCALAR_END:
+                    continue
+                self._end_scalar(pos)
+                if self.complete:
+                    break
+
+            if c in self._WHITESPACE:
+                pass
+            elif c == '"':
+                self._in_string = True
+                self._token_start = pos
+            elif c in "{[":
+                self._stack.append(_Frame(c, pos))
+            elif c in "}]":
+                frame = self._current_frame(c, pos)
+                if frame.kind != ("{" if c == "}" else "["):
+                    raise IncrementalJSONError(f"Unexpected '{c}' closing '{frame.kind}' at position {pos}")
+                self._stack.pop()
+                self._emit(frame.start, pos + 1)
+                if not self._stack:
+                    self.complete = True
+                    break
+            elif c == ":":
+                self._current_frame(c, pos).expecting_key = False
+            elif c == ",":
+                frame = self._current_frame(c, pos)
+                if frame.kind == "{":
+                    frame.expecting_key = True
+                else:
+                    frame.index += 1
+            else:
+                self._token_start = pos
+
+    def close(self):
+        """
+        Ends the input. A number or literal at the very end of a bare scalar document
+        is only known to be complete here.
+        """
+        if not self.complete and self._token_start is not None and not self._in_string and not self._stack:
+            self._end_scalar(self._length)
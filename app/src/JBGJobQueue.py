@@ -0,0 +1,313 @@
+import os
+import json
+import signal
+import zipfile
+import threading
+import multiprocessing
+import logging
+from pathlib import Path
+from typing import Dict, Optional, Union
+from app.src.JBGJobStore import JobStore
+from app.src.JBGAnnualReportExceptions import EmptyOutputException, FileTypeException
+
+logger = logging.getLogger(__name__)
+
+
+def run_analysis(
+    input_dir: Union[str, Path],
+    filename: str,
+    model: str,
+    output_format: str,
+    include_sources: bool,
+    use_masking: bool,
+    instruction_path: Union[str, Path],
+    metrics_path: Union[str, Path],
+    fund_names_path: Union[str, Path],
+    cache_dir: Union[str, Path] = None,
+    api_key: str = None,
+    execution_mode: str = None,
+    rate_limiter=None,
+    cpu_budget: int = None
+) -> tuple[Path, dict]:
+    """
+    Runs the analysis of the uploaded file in input_dir and converts the result to
+    the requested format. Returns the path of the result file and the result JSON.
+    With execution_mode "batch" the chunks are sent through the OpenAI Batch API.
+    Without a rate_limiter the analyzer uses the shared limiter of the process.
+    cpu_budget is the number of cores OCR may use, by default all of them.
+    """
+    # Imported here so that the web process does not load the analysis stack at startup
+    from app.src.JBGAnnualReportAnalysis import JBGAnnualReportAnalyzer
+    from app.src.JBGJSONConverter import JsonConverter
+
+    input_dir = Path(input_dir)
+    if filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(input_dir / filename, 'r') as zip_ref:
+            zip_ref.extractall(input_dir)
+
+    analys = JBGAnnualReportAnalyzer(
+        upload_dir=input_dir,
+        instruction_path=instruction_path,
+        metrics_path=metrics_path,
+        use_masking=use_masking,
+        cache_dir=cache_dir,
+        openai_api_key=api_key,
+        execution_mode=execution_mode,
+        rate_limiter=rate_limiter,
+        cpu_budget=cpu_budget
+    )
+
+    json_output_path = input_dir / f"{Path(filename).stem}_resultat.json"
+    analys_result_path = analys.do_analysis(json_output_path, model=model)
+    if not analys_result_path:
+        raise EmptyOutputException(message="Ingen fil verkar ha analyserats")
+    resultat_json = json.loads(analys_result_path.read_text(encoding="utf-8"))
+
+    converter = JsonConverter(json_output_path, include_sources=include_sources)
+    if output_format == "csv":
+        output_path = input_dir / f"{Path(filename).stem}_resultat.csv"
+        converter.to_csv(output_path)
+    elif output_format == "xlsx":
+        output_path = input_dir / f"{Path(filename).stem}_resultat_by_fund.xlsx"
+        converter.to_excel_by_year(output_path, key_def_path=metrics_path, fund_names=fund_names_path)
+    elif output_format == "json":
+        # Already written by `do_analysis` → no action needed
+        output_path = json_output_path
+    else:
+        raise ValueError("Ogiltigt format valt.")
+    return output_path, resultat_json
+
+
+def run_analysis_job(
+    db_dir: str, job_id: str, api_key: Optional[str], log_file: Optional[str] = None, limit_share: int = 1,
+    cpu_budget: int = None
+):
+    """
+    Entry point of a worker process: runs one job and records the outcome in the store.
+    Logs go to stderr and, if given, to the log file of the server. The job gets
+    1/limit_share of the API rate limits, since up to limit_share jobs run at once,
+    and uses at most cpu_budget cores for OCR.
+    """
+    # Imported here for the same reason as in run_analysis
+    from app.src.JBGRateLimiter import RateLimiter
+
+    # Lead a process group of our own, so that cancelling the job also reaches the
+    # OCR and masking pool processes started below
+    if hasattr(os, "setsid"):
+        os.setsid()
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [%(levelname)s] [jobb {job_id[:8]}] %(message)s",
+        handlers=handlers
+    )
+    store = JobStore(db_dir)
+    job = store.get(job_id)
+    params = job["params"]
+    try:
+        output_path, _ = run_analysis(
+            api_key=api_key, rate_limiter=RateLimiter(limit_share=limit_share), cpu_budget=cpu_budget, **params
+        )
+        store.finish(
+            job_id, JobStore.STATUS_DONE,
+            result_filename=output_path.name,
+            message=f"Analysen av {params['filename']} är klar."
+        )
+    except (EmptyOutputException, FileTypeException) as ex:
+        store.finish(job_id, JobStore.STATUS_FAILED, error=ex.message)
+    except Exception as ex:
+        logger.exception(f"Jobb {job_id} misslyckades")
+        store.finish(job_id, JobStore.STATUS_FAILED, error=str(ex))
+
+
+class JobQueue:
+    """
+    Runs queued analysis jobs in separate worker processes, at most max_workers at a time.
+
+    A dispatcher thread in the web process starts a process per job, so a running job
+    can be cancelled by terminating its process group, which also ends the pool
+    processes the job has started. Every job process gets an equal share of the API
+    rate limits and writes its log to log_file, if given. The cores are split the
+    same way unless cpus_per_job is given. API keys are only kept in memory and
+    handed to the worker process, so each server process only runs the jobs submitted
+    to it. Several server processes can share the store: jobs whose owning process
+    is gone are put back in the queue if a server-wide OPENAI_API_KEY is set,
+    otherwise they are marked as interrupted.
+    """
+    DEFAULT_MAX_WORKERS = 2
+    POLL_INTERVAL = 1.0
+    TERMINATE_TIMEOUT = 5.0
+
+    def __init__(
+        self, store: JobStore, max_workers: int = None, poll_interval: float = None,
+        log_file: Union[str, Path] = None, cpus_per_job: int = None
+    ):
+        self.store = store
+        self.log_file = str(log_file) if log_file else None
+        self.max_workers = max(1, max_workers or self.DEFAULT_MAX_WORKERS)
+        self.cpus_per_job = max(1, cpus_per_job or (os.cpu_count() or 1) // self.max_workers)
+        self.poll_interval = poll_interval if poll_interval else self.POLL_INTERVAL
+        self._context = multiprocessing.get_context("spawn")
+        self._api_keys: Dict[str, str] = {}
+        self._processes: Dict[str, multiprocessing.Process] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.pid = os.getpid()
+
+    def submit(self, params: dict, api_key: str = None, job_id: str = None) -> str:
+        job_id = self.store.create(params, job_id, owner_pid=self.pid)
+        if api_key:
+            with self._lock:
+                self._api_keys[job_id] = api_key
+        self._wakeup.set()
+        return job_id
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        status = self.store.request_cancel(job_id)
+        with self._lock:
+            self._api_keys.pop(job_id, None)
+        self._wakeup.set()
+        return status
+
+    def start(self):
+        self._recover()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="job-dispatcher", daemon=True)
+        self._thread.start()
+        logger.info(f"Job queue started with {self.max_workers} worker process(es)")
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        with self._lock:
+            processes = dict(self._processes)
+        for job_id, process in processes.items():
+            # Left as running in the store; handled by _recover on the next start
+            self._terminate(process)
+
+    @staticmethod
+    def _signal_group(process: multiprocessing.Process, sig: int) -> bool:
+        """
+        Sends sig to the process group led by the job process. Returns False where
+        process groups are not available or the group is already gone.
+        """
+        if not hasattr(os, "killpg") or not process.pid:
+            return False
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            return False
+        return True
+
+    def _terminate(self, process: multiprocessing.Process):
+        # The group does not exist until the worker has called setsid, so fall back
+        # to the process itself for a job that has only just been started
+        if not self._signal_group(process, signal.SIGTERM):
+            process.terminate()
+        process.join(self.TERMINATE_TIMEOUT)
+        if process.is_alive():
+            if not self._signal_group(process, signal.SIGKILL):
+                process.kill()
+            process.join()
+        # Pool processes that ignored SIGTERM
+        self._signal_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+    @staticmethod
+    def _is_process_alive(pid: Optional[int]) -> bool:
+        if not pid:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _recover(self):
+        can_requeue = bool(os.environ.get("OPENAI_API_KEY"))
+        for job in self.store.list_by_status(JobStore.STATUS_QUEUED, JobStore.STATUS_RUNNING):
+            if job["owner_pid"] != self.pid and self._is_process_alive(job["owner_pid"]):
+                continue
+            if can_requeue:
+                logger.info(f"Requeueing job {job['id']} after restart")
+                self.store.update(
+                    job["id"], status=JobStore.STATUS_QUEUED, started_at=None, cancel_requested=0, owner_pid=self.pid
+                )
+            else:
+                logger.warning(f"Job {job['id']} was interrupted by a restart and has no API key to resume with")
+                self.store.finish(
+                    job["id"], JobStore.STATUS_INTERRUPTED,
+                    error="Jobbet avbröts när servern startades om. Skicka in filen igen."
+                )
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._reap_finished()
+                self._terminate_cancelled()
+                self._start_queued()
+            except Exception as e:
+                logger.error(f"Job dispatcher error: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _reap_finished(self):
+        with self._lock:
+            finished = [(job_id, p) for job_id, p in self._processes.items() if not p.is_alive()]
+            for job_id, _ in finished:
+                del self._processes[job_id]
+        for job_id, process in finished:
+            process.join()
+            # Pool processes left behind by a worker that died
+            self._signal_group(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+            job = self.store.get(job_id)
+            if job and job["status"] == JobStore.STATUS_RUNNING:
+                self.store.finish(
+                    job_id, JobStore.STATUS_FAILED,
+                    error=f"Arbetsprocessen avslutades oväntat (kod {process.exitcode})."
+                )
+
+    def _terminate_cancelled(self):
+        with self._lock:
+            running = dict(self._processes)
+        for job_id, process in running.items():
+            job = self.store.get(job_id)
+            if job and job["cancel_requested"] and process.is_alive():
+                logger.info(f"Cancelling running job {job_id}")
+                self._terminate(process)
+                with self._lock:
+                    self._processes.pop(job_id, None)
+                self.store.finish(job_id, JobStore.STATUS_CANCELLED)
+
+    def _start_queued(self):
+        with self._lock:
+            free_slots = self.max_workers - len(self._processes)
+        if free_slots <= 0:
+            return
+        queued = [job for job in self.store.list_by_status(JobStore.STATUS_QUEUED) if job["owner_pid"] == self.pid]
+        for job in queued[:free_slots]:
+            job_id = job["id"]
+            with self._lock:
+                api_key = self._api_keys.pop(job_id, None)
+            api_key = api_key or os.environ.get("OPENAI_API_KEY")
+            if not api_key:
+                self.store.finish(job_id, JobStore.STATUS_INTERRUPTED, error="Ingen API-nyckel finns för jobbet.")
+                continue
+            if not self.store.claim(job_id, owner_pid=self.pid):
+                continue
+            process = self._context.Process(
+                target=run_analysis_job,
+                args=(str(self.store.db_dir), job_id, api_key, self.log_file, self.max_workers, self.cpus_per_job),
+                name=f"job-{job_id[:8]}"
+            )
+            process.start()
+            with self._lock:
+                self._processes[job_id] = process
+            logger.info(f"Started job {job_id} in process {process.pid}")
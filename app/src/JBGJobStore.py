@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class JobStore:
+    """
+    Persistent store of analysis jobs in a SQLite database.
+
+    A job holds its parameters, its status and, when finished, the name of the
+    result file or the error, and the pid of the server process that owns it. The
+    store is shared between server and worker processes, so every operation opens
+    its own connection. API keys are never stored.
+    """
+    DB_NAME = "jobs.db"
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_INTERRUPTED = "interrupted"
+    FINAL_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED, STATUS_INTERRUPTED)
+    COLUMNS = (
+        "id", "status", "params", "message", "result_filename", "error",
+        "cancel_requested", "created_at", "started_at", "finished_at", "owner_pid"
+    )
+
+    def __init__(self, db_dir: Union[str, Path]):
+        self.db_dir = Path(db_dir)
+        self.db_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.db_dir / self.DB_NAME
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    message TEXT,
+                    result_filename TEXT,
+                    error TEXT,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    owner_pid INTEGER
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner_pid" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _to_dict(self, row) -> dict:
+        job = dict(zip(self.COLUMNS, row))
+        job["params"] = json.loads(job["params"])
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    @staticmethod
+    def new_job_id() -> str:
+        return uuid.uuid4().hex
+
+    def create(self, params: dict, job_id: str = None, owner_pid: int = None) -> str:
+        job_id = job_id if job_id else self.new_job_id()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, created_at, owner_pid) VALUES (?, ?, ?, ?, ?)",
+                (job_id, self.STATUS_QUEUED, json.dumps(params, ensure_ascii=False), time.time(), owner_pid)
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list_by_status(self, *statuses: str) -> List[dict]:
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at",
+                statuses
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def update(self, job_id: str, **fields):
+        unknown = set(fields) - set(self.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {sorted(unknown)}")
+        if "params" in fields:
+            fields["params"] = json.dumps(fields["params"], ensure_ascii=False)
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id: str, owner_pid: int = None) -> bool:
+        """
+        Marks a queued job as running. Returns False if it is no longer queued.
+        """
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ?, owner_pid = COALESCE(?, owner_pid) WHERE id = ? AND status = ?",
+                (self.STATUS_RUNNING, time.time(), owner_pid, job_id, self.STATUS_QUEUED)
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job_id: str, status: str, **fields):
+        self.update(job_id, status=status, finished_at=time.time(), **fields)
+
+    def request_cancel(self, job_id: str) -> Optional[str]:
+        """
+        Cancels a queued job at once and flags a running one for the worker pool.
+        Returns the status after the request, or None for an unknown job.
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (self.STATUS_CANCELLED, time.time(), job_id, self.STATUS_QUEUED)
+            )
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, self.STATUS_RUNNING)
+            )
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
@@ -0,0 +1,96 @@
+import hashlib
+import time
+import json
+import os
+import shutil
+import tempfile
+import threading
+import logging
+from pathlib import Path
+from typing import List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class OCRCache:
+    """
+    Persistent store of OCR output PDFs, kept outside the per-request upload directory.
+
+    Entries are keyed on the SHA-256 of the input PDF together with the OCR settings
+    and the selected pages. Files are written atomically and the least recently used
+    ones are removed once the cache grows beyond max_size_bytes. get() hands out a
+    link or copy of the entry in the caller's directory, so an eviction by another
+    process cannot remove a file that is still being read. Entries used within
+    EVICTION_GRACE_SECONDS are never evicted.
+    """
+    DEFAULT_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024
+    EVICTION_GRACE_SECONDS = 10 * 60
+    FILE_SUFFIX = ".ocr.pdf"
+
+    def __init__(self, cache_dir: Union[str, Path], max_size_bytes: int = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes if max_size_bytes else self.DEFAULT_MAX_SIZE_BYTES
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(file_hash: str, pages: List[int], language: str, deskew: bool) -> str:
+        payload = json.dumps([file_hash, sorted(pages), language, deskew])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path_for(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{self.FILE_SUFFIX}"
+
+    def get(self, key: str, target: Union[str, Path]) -> Optional[Path]:
+        """
+        Places the cached output at target and returns target, or None on a cache miss.
+        """
+        path = self._path_for(key)
+        target = Path(target)
+        try:
+            os.utime(path)
+            if target.exists():
+                target.unlink()
+            try:
+                os.link(path, target)
+            except OSError:
+                # Other file system than the cache, or no hard link support
+                shutil.copyfile(path, target)
+        except FileNotFoundError:
+            return None
+        return target
+
+    def put(self, key: str, ocr_path: Union[str, Path]) -> Path:
+        target = self._path_for(key)
+        fd, temp_name = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(ocr_path, "rb") as src:
+                shutil.copyfileobj(src, dst)
+            os.replace(temp_name, target)
+        except Exception:
+            if os.path.exists(temp_name):
+                os.unlink(temp_name)
+            raise
+        self._evict()
+        return target
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for path in self.cache_dir.glob(f"*{self.FILE_SUFFIX}"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total_size = sum(size for _, size, _ in entries)
+            grace_cutoff = time.time() - self.EVICTION_GRACE_SECONDS
+            for mtime, size, path in sorted(entries):
+                if total_size <= self.max_size_bytes or mtime >= grace_cutoff:
+                    break
+                try:
+                    path.unlink()
+                    total_size -= size
+                    logger.debug(f"Evicted cached OCR output {path.name}")
+                except OSError:
+                    pass
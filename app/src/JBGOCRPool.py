@@ -0,0 +1,71 @@
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import ocrmypdf
+
+logger = logging.getLogger(__name__)
+
+OCR_LANGUAGE = "swe"
+OCR_DESKEW = True
+
+
+def run_ocr(input_path: str, output_path: str, pages: List[int], jobs: int = None, use_threads: bool = False) -> str:
+    """
+    OCR:ar angivna sidor (0-baserade index) i en PDF och skriver resultatet till output_path
+    """
+    ocrmypdf.ocr(
+        str(input_path),
+        str(output_path),
+        language=OCR_LANGUAGE,
+        deskew=OCR_DESKEW,
+        force_ocr=True,
+        pages=",".join(str(index + 1) for index in pages),
+        jobs=jobs,
+        use_threads=use_threads,
+        progress_bar=False
+    )
+    return str(output_path)
+
+
+class OCRPool:
+    """
+    Runs OCR for several documents at once in a process pool.
+
+    Each document gets its own worker process, and the cores of cpu_budget are split
+    between the workers through ocrmypdf's jobs setting so the pages of each
+    document are also processed in parallel. cpu_budget defaults to all cores of
+    the machine; a job that shares the machine with other jobs passes its own share.
+    """
+
+    def __init__(self, max_workers: int = None, cpu_budget: int = None):
+        self.cpu_count = max(1, cpu_budget or os.cpu_count() or 1)
+        self.max_workers = max(1, min(max_workers or self.cpu_count, self.cpu_count))
+
+    def ocr_documents(self, requests: List[Tuple[Path, Path, List[int]]]) -> Dict[Path, Optional[Path]]:
+        """
+        Takes (input_path, output_path, page_indices) per document and returns a mapping
+        from input path to the OCR output, or None where OCR failed.
+        """
+        results = {}
+        if not requests:
+            return results
+        num_workers = min(self.max_workers, len(requests))
+        jobs_per_document = max(1, self.cpu_count // num_workers)
+        logger.info(f"OCR of {len(requests)} document(s) with {num_workers} worker(s) and {jobs_per_document} job(s) each")
+
+        # Spawn, since forking a process that runs threads (the analysis and the rate limiter) is unsafe
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {
+                input_path: executor.submit(run_ocr, str(input_path), str(output_path), pages, jobs_per_document, True)
+                for input_path, output_path, pages in requests
+            }
+            for input_path, future in futures.items():
+                try:
+                    results[input_path] = Path(future.result())
+                except Exception as e:
+                    logger.warning(f"OCR failed for {input_path.name}: {e}")
+                    results[input_path] = None
+        return results
@@ -0,0 +1,211 @@
+import copy
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+import fitz
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path: Union[str, Path], block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PDFDocument:
+    """
+    Text and layout of a PDF, extracted once and shared by every analysis stage.
+
+    Each page holds its plain text, its text lines with vertical positions (used to
+    find printed page numbers) and simple text-layer statistics. Loaded documents are
+    kept in memory for the process and can also be pickled to a cache directory,
+    keyed by the SHA-256 of the file.
+    """
+    CACHE_VERSION = 1
+    MAX_DOCUMENTS_IN_MEMORY = 16
+    MAX_DOCUMENTS_ON_DISK = 500
+
+    _memory_cache = OrderedDict()
+    _memory_cache_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path: Path,
+        file_hash: str,
+        page_texts: List[str],
+        page_lines: List[List[Tuple[float, float, str]]],
+        page_sizes: List[Tuple[float, float]],
+        page_image_coverage: List[float]
+    ):
+        self.path = Path(path)
+        self.file_hash = file_hash
+        self.page_texts = page_texts
+        self.page_lines = page_lines
+        self.page_sizes = page_sizes
+        self.page_image_coverage = page_image_coverage
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_texts)
+
+    @property
+    def page_char_counts(self) -> List[int]:
+        return [len(text.strip()) for text in self.page_texts]
+
+    @property
+    def total_char_count(self) -> int:
+        return sum(self.page_char_counts)
+
+    def page_text_density(self, index: int) -> float:
+        """
+        Characters per square inch of page area (72 points to the inch).
+        """
+        width, height = self.page_sizes[index]
+        area = (width / 72.0) * (height / 72.0)
+        return self.page_char_counts[index] / area if area > 0 else 0.0
+
+    def has_retrievable_text(self) -> bool:
+        return any(text.strip() for text in self.page_texts)
+
+    def with_pages_from(self, other: "PDFDocument", page_indices: List[int]) -> "PDFDocument":
+        """
+        Returns a copy of this document where the given pages are taken from another
+        rendering of the same document, e.g. its OCR output.
+        """
+        page_texts, page_lines = list(self.page_texts), list(self.page_lines)
+        for index in page_indices:
+            page_texts[index] = other.page_texts[index]
+            page_lines[index] = other.page_lines[index]
+        return PDFDocument(
+            self.path, self.file_hash, page_texts, page_lines, list(self.page_sizes), list(self.page_image_coverage)
+        )
+
+    @classmethod
+    def from_pdf(cls, pdf_path: Union[str, Path], file_hash: str = None) -> "PDFDocument":
+        pdf_path = Path(pdf_path)
+        if not file_hash:
+            file_hash = file_sha256(pdf_path)
+        page_texts, page_lines, page_sizes, page_image_coverage = [], [], [], []
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                page_texts.append(page.get_text())
+                lines = []
+                for block in page.get_text("dict").get("blocks", []):
+                    if block.get("type") != 0:
+                        continue
+                    for line in block.get("lines", []):
+                        _, y0, _, y1 = line["bbox"]
+                        text = "".join(span.get("text", "") for span in line.get("spans", []))
+                        lines.append((y0, y1, text))
+                page_lines.append(lines)
+                rect = page.rect
+                page_sizes.append((rect.width, rect.height))
+                page_image_coverage.append(cls._image_coverage(page))
+        return cls(pdf_path, file_hash, page_texts, page_lines, page_sizes, page_image_coverage)
+
+    @staticmethod
+    def _image_coverage(page) -> float:
+        page_area = abs(page.rect)
+        if page_area <= 0:
+            return 0.0
+        covered = 0.0
+        try:
+            for info in page.get_image_info():
+                covered += abs(fitz.Rect(info["bbox"]) & page.rect)
+        except Exception as e:
+            logger.debug(f"Could not read image info from page {page.number}: {e}")
+        return min(covered / page_area, 1.0)
+
+    @classmethod
+    def load(cls, pdf_path: Union[str, Path], cache_dir: Optional[Union[str, Path]] = None) -> "PDFDocument":
+        """
+        Returns the document for the file, reusing an earlier extraction of identical
+        content from memory or from cache_dir when possible.
+        """
+        pdf_path = Path(pdf_path)
+        file_hash = file_sha256(pdf_path)
+
+        with cls._memory_cache_lock:
+            document = cls._memory_cache.get(file_hash)
+            if document is not None:
+                cls._memory_cache.move_to_end(file_hash)
+        if document is None and cache_dir:
+            document = cls._read_from_disk(Path(cache_dir), file_hash)
+        if document is None:
+            logger.debug(f"Extracting text and layout from {pdf_path.name}")
+            document = cls.from_pdf(pdf_path, file_hash)
+            if cache_dir:
+                cls._write_to_disk(Path(cache_dir), document)
+
+        with cls._memory_cache_lock:
+            cls._memory_cache[file_hash] = document
+            cls._memory_cache.move_to_end(file_hash)
+            while len(cls._memory_cache) > cls.MAX_DOCUMENTS_IN_MEMORY:
+                cls._memory_cache.popitem(last=False)
+        # The same content may have been seen under another name, so each caller gets
+        # its own copy with its own path instead of changing the shared instance
+        document = copy.copy(document)
+        document.path = pdf_path
+        return document
+
+    @classmethod
+    def load_page_texts(cls, pdf_path: Union[str, Path]) -> List[str]:
+        """
+        Returns the plain text of each page. Uses a document already loaded in memory,
+        otherwise only the text is extracted, without layout or image statistics.
+        """
+        pdf_path = Path(pdf_path)
+        with cls._memory_cache_lock:
+            document = cls._memory_cache.get(file_sha256(pdf_path))
+        if document is not None:
+            return list(document.page_texts)
+        with fitz.open(pdf_path) as doc:
+            return [page.get_text() for page in doc]
+
+    @classmethod
+    def _cache_file(cls, cache_dir: Path, file_hash: str) -> Path:
+        return cache_dir / f"{file_hash}.v{cls.CACHE_VERSION}.pkl"
+
+    @classmethod
+    def _read_from_disk(cls, cache_dir: Path, file_hash: str) -> Optional["PDFDocument"]:
+        cache_file = cls._cache_file(cache_dir, file_hash)
+        if not cache_file.exists():
+            return None
+        try:
+            with cache_file.open("rb") as f:
+                document = pickle.load(f)
+            os.utime(cache_file)
+            return document
+        except Exception as e:
+            logger.warning(f"Could not read cached document {cache_file.name}: {e}")
+            return None
+
+    @classmethod
+    def _write_to_disk(cls, cache_dir: Path, document: "PDFDocument"):
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, temp_name = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_name, cls._cache_file(cache_dir, document.file_hash))
+            cls._prune_disk_cache(cache_dir)
+        except Exception as e:
+            logger.warning(f"Could not cache document {document.path.name}: {e}")
+
+    @classmethod
+    def _prune_disk_cache(cls, cache_dir: Path):
+        cache_files = sorted(cache_dir.glob("*.pkl"), key=lambda f: f.stat().st_mtime)
+        for cache_file in cache_files[:max(0, len(cache_files) - cls.MAX_DOCUMENTS_ON_DISK)]:
+            try:
+                cache_file.unlink()
+            except OSError:
+                pass
@@ -0,0 +1,155 @@
+import json
+import threading
+import logging
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class PromptTemplates:
+    """
+    Loads the GPT instructions and the metrics definitions once per process.
+
+    The files are read again only when their modification time changes. Built system
+    prompts are memoized per year and metric selection, so the same input always
+    gives a byte-identical prompt.
+    """
+    METRIC_KEY_NUMBER_KEY = "Nyckeltal"
+    METRIC_KEY_NUMBER_ALTERNATE_KEY = "Alternativa benämningar"
+    STANDARD_ENCODING = "utf-8"
+    LAYOUT_LEGACY = "legacy"
+    LAYOUT_PREFIX_CACHED = "prefix_cached"
+
+    _instances: Dict[Tuple[str, str], "PromptTemplates"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, instruction_path: Union[str, Path], metrics_path: Union[str, Path]):
+        self.instruction_path = Path(instruction_path)
+        self.metrics_path = Path(metrics_path)
+        self._lock = threading.RLock()
+        self._mtimes = None
+        self._instruction = None
+        self._metrics = None
+        self._metrics_json = None
+        self._key_number_terms = None
+        self._system_prompts: Dict[tuple, str] = {}
+
+    @classmethod
+    def get(cls, instruction_path: Union[str, Path], metrics_path: Union[str, Path]) -> "PromptTemplates":
+        key = (str(Path(instruction_path).resolve()), str(Path(metrics_path).resolve()))
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(instruction_path, metrics_path)
+            return cls._instances[key]
+
+    def _refresh(self):
+        mtimes = (self.instruction_path.stat().st_mtime, self.metrics_path.stat().st_mtime)
+        if mtimes == self._mtimes:
+            return
+        logger.debug(f"Loading prompt templates from {self.instruction_path.name} and {self.metrics_path.name}")
+        self._instruction = self.instruction_path.read_text(encoding=self.STANDARD_ENCODING)
+        self._metrics = json.loads(self.metrics_path.read_text(encoding=self.STANDARD_ENCODING))
+        self._metrics_json = json.dumps(self._metrics, ensure_ascii=False, indent=2)
+        key_number_terms = [metric.get(self.METRIC_KEY_NUMBER_KEY) for metric in self._metrics]
+        for metric in self._metrics:
+            key_number_terms += list(metric.get(self.METRIC_KEY_NUMBER_ALTERNATE_KEY) or [])
+        self._key_number_terms = key_number_terms
+        self._system_prompts = {}
+        self._mtimes = mtimes
+
+    @property
+    def instruction(self) -> str:
+        with self._lock:
+            self._refresh()
+            return self._instruction
+
+    @property
+    def metrics(self) -> List[dict]:
+        with self._lock:
+            self._refresh()
+            return self._metrics
+
+    @property
+    def metrics_json(self) -> str:
+        with self._lock:
+            self._refresh()
+            return self._metrics_json
+
+    @property
+    def key_number_terms(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return self._key_number_terms
+
+    def system_prompt(self, the_year: int = None, metrics: List[dict] = None, layout: str = LAYOUT_LEGACY) -> str:
+        """
+        In the prefix-cached layout the year is left out of the system prompt, which then
+        only holds the stable instruction and metric definitions; see request_text().
+        """
+        with self._lock:
+            self._refresh()
+            metric_names = None if metrics is None else tuple(
+                metric.get(self.METRIC_KEY_NUMBER_KEY) for metric in metrics
+            )
+            if layout == self.LAYOUT_PREFIX_CACHED:
+                the_year = None
+            key = (layout, the_year, metric_names)
+            if key not in self._system_prompts:
+                if metrics is None:
+                    metrics_json = self._metrics_json
+                else:
+                    metrics_json = json.dumps(metrics, ensure_ascii=False, indent=2)
+                if layout == self.LAYOUT_PREFIX_CACHED:
+                    self._system_prompts[key] = self._render_prefix_cached_system_prompt(self._instruction, metrics_json)
+                else:
+                    self._system_prompts[key] = self._render_system_prompt(self._instruction, metrics_json, the_year)
+            return self._system_prompts[key]
+
+    @staticmethod
+    def request_text(extracted_text: str, the_year: int = None, layout: str = LAYOUT_LEGACY) -> str:
+        if layout == PromptTemplates.LAYOUT_PREFIX_CACHED:
+            lines = ["Analysera följande årsredovisningsutdrag:", "----------------", extracted_text, "----------------"]
+            if the_year:
+                lines.append(f"Nyckeltalen ska extraheras för {the_year}.")
+            lines.append("Returnera endast en giltig JSON-struktur enligt instruktionerna – ingen annan text.")
+            return "\n".join(lines)
+
+        request_text = f"""
+            Analysera följande årsredovisningsutdrag:
+            ----------------
+            {extracted_text}
+            ----------------
+            Returnera endast en giltig JSON-struktur enligt instruktionerna – ingen annan text.
+        """
+        return request_text
+
+    @staticmethod
+    def _render_prefix_cached_system_prompt(instruction: str, metrics_json: str) -> str:
+        return "\n".join([
+            instruction.strip(),
+            "-------------",
+            "Följande nyckeltal ska extraheras:",
+            "-------------",
+            metrics_json
+        ])
+
+    @staticmethod
+    def _render_system_prompt(instruction: str, metrics_json: str, the_year: int = None) -> str:
+        if the_year:
+            system_prompt = f"""
+                {instruction}
+                -------------
+                Följande nyckeltal ska extraheras för {the_year}:
+                -------------
+                {metrics_json}
+            """
+        else:
+            system_prompt = f"""
+                {instruction}
+                -------------
+                Följande nyckeltal ska extraheras:
+                -------------
+                {metrics_json}
+            """
+        return system_prompt
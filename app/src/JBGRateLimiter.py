@@ -0,0 +1,183 @@
+import threading
+import time
+import logging
+from typing import Dict, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    A simple thread-safe token bucket that refills continuously up to its capacity.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.available = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.available = min(self.capacity, self.available + elapsed * self.refill_per_second)
+            self.updated_at = now
+
+    def seconds_until_available(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # A reservation larger than the whole bucket is allowed once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_per_second
+
+    def consume(self, amount: float):
+        self.available -= amount
+
+    def give_back(self, amount: float):
+        self.available = min(self.capacity, self.available + amount)
+
+    def resize(self, capacity: float, refill_per_second: float, now: float):
+        self._refill(now)
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.available = min(self.available, self.capacity)
+
+
+class RateLimiter:
+    """
+    Keeps requests-per-minute and tokens-per-minute budgets per model.
+
+    Callers reserve capacity with acquire() before each API call and settle the
+    reservation with record_usage() once the real token usage is known. Limits
+    reported by the API in the x-ratelimit-* headers replace the configured ones,
+    and retry-after hints pause all callers of the model.
+
+    The budgets only cover the calls made through this instance. When several
+    processes call the API with the same account, e.g. the job processes of
+    JobQueue, each process takes 1/limit_share of every limit.
+    """
+    DEFAULT_REQUESTS_PER_MINUTE = 500
+    DEFAULT_TOKENS_PER_MINUTE = 30000
+    MODEL_LIMITS = {
+        "gpt-4o": (500, 30000),
+        "gpt-5": (500, 30000),
+        "gpt-5-mini": (500, 200000),
+    }
+    CHARS_PER_TOKEN_ESTIMATE = 4
+    EXPECTED_COMPLETION_TOKENS = 1000
+    MAX_WAIT_STEP = 5.0
+
+    def __init__(self, model_limits: Optional[Mapping[str, Tuple[int, int]]] = None, limit_share: int = 1):
+        self.model_limits = dict(self.MODEL_LIMITS)
+        if model_limits:
+            self.model_limits.update(model_limits)
+        self.limit_share = max(1, int(limit_share))
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._paused_until: Dict[str, float] = {}
+
+    def _get_buckets(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets:
+            rpm, tpm = self.model_limits.get(
+                model, (self.DEFAULT_REQUESTS_PER_MINUTE, self.DEFAULT_TOKENS_PER_MINUTE)
+            )
+            rpm, tpm = self._share(rpm), self._share(tpm)
+            self._buckets[model] = (TokenBucket(rpm, rpm / 60.0), TokenBucket(tpm, tpm / 60.0))
+        return self._buckets[model]
+
+    def _share(self, limit: float) -> float:
+        return max(1.0, limit / self.limit_share)
+
+    def estimate_tokens(self, *texts: str) -> int:
+        chars = sum(len(text) for text in texts if text)
+        return chars // self.CHARS_PER_TOKEN_ESTIMATE + self.EXPECTED_COMPLETION_TOKENS
+
+    def acquire(self, model: str, tokens: int) -> int:
+        """
+        Blocks until one request and the given number of tokens fit in the budgets
+        of the model, then reserves them. Returns the number of reserved tokens.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                requests, token_budget = self._get_buckets(model)
+                wait = max(
+                    self._paused_until.get(model, 0.0) - now,
+                    requests.seconds_until_available(1, now),
+                    token_budget.seconds_until_available(tokens, now),
+                )
+                if wait <= 0:
+                    requests.consume(1)
+                    token_budget.consume(tokens)
+                    return tokens
+            logger.debug(f"Rate limiter for {model}: waiting {wait:.2f}s for capacity")
+            time.sleep(min(wait, self.MAX_WAIT_STEP))
+
+    def record_usage(self, model: str, reserved_tokens: int, used_tokens: Optional[int]):
+        """
+        Settles a reservation with the token count reported in response.usage.
+        """
+        if used_tokens is None:
+            return
+        with self._lock:
+            _, token_budget = self._get_buckets(model)
+            difference = reserved_tokens - used_tokens
+            if difference > 0:
+                token_budget.give_back(difference)
+            else:
+                token_budget.consume(-difference)
+
+    def update_from_headers(self, model: str, headers: Mapping[str, str]):
+        """
+        Adopts the account limits reported by the API for the model.
+        """
+        try:
+            rpm = int(headers.get("x-ratelimit-limit-requests", 0))
+            tpm = int(headers.get("x-ratelimit-limit-tokens", 0))
+        except (TypeError, ValueError):
+            return
+        rpm = self._share(rpm) if rpm > 0 else 0
+        tpm = self._share(tpm) if tpm > 0 else 0
+        with self._lock:
+            now = time.monotonic()
+            requests, token_budget = self._get_buckets(model)
+            if rpm > 0 and rpm != requests.capacity:
+                requests.resize(rpm, rpm / 60.0, now)
+            if tpm > 0 and tpm != token_budget.capacity:
+                token_budget.resize(tpm, tpm / 60.0, now)
+
+    def pause(self, model: str, seconds: float):
+        """
+        Stops all calls for the model for the given number of seconds, e.g. after a retry-after hint.
+        """
+        with self._lock:
+            until = time.monotonic() + max(seconds, 0.0)
+            self._paused_until[model] = max(self._paused_until.get(model, 0.0), until)
+        logger.info(f"Rate limiter for {model}: pausing calls for {seconds:.1f}s")
+
+    @staticmethod
+    def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+        if not headers:
+            return None
+        for key, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            value = headers.get(key)
+            if value is None:
+                continue
+            try:
+                return float(value) * scale
+            except (TypeError, ValueError):
+                continue
+        return None
+
+
+_shared_rate_limiter = None
+_shared_rate_limiter_lock = threading.Lock()
+
+
+def get_shared_rate_limiter() -> RateLimiter:
+    global _shared_rate_limiter
+    with _shared_rate_limiter_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = RateLimiter()
+        return _shared_rate_limiter
@@ -0,0 +1,128 @@
+import json
+import math
+import re
+import threading
+import logging
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class RelevanceFilter:
+    """
+    Scores report pages against the metric names and their alternative names.
+
+    The term index is built once from the metrics definitions. Pages are ranked with
+    BM25 over the metric words, plus a bonus for every occurrence of a full metric
+    name, which also catches names inside Swedish compound words.
+    """
+    METRIC_KEY_NUMBER_KEY = "Nyckeltal"
+    METRIC_KEY_NUMBER_ALTERNATE_KEY = "Alternativa benämningar"
+    STANDARD_ENCODING = "utf-8"
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+    PHRASE_BONUS = 2.0
+    MIN_TERM_LENGTH = 3
+    STOP_WORDS = {"och", "för", "till", "av", "på", "med", "som", "det", "den", "att", "om", "summa"}
+    _WORD_RE = re.compile(r"[a-zåäöéü]+")
+
+    _instances: Dict[Tuple[str, float], "RelevanceFilter"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, metrics: List[dict]):
+        self.metric_phrases: Dict[str, List[str]] = {}
+        for metric in metrics:
+            name = metric.get(self.METRIC_KEY_NUMBER_KEY)
+            if not name:
+                continue
+            phrases = [name] + list(metric.get(self.METRIC_KEY_NUMBER_ALTERNATE_KEY) or [])
+            self.metric_phrases[name] = sorted({phrase.lower().strip() for phrase in phrases if phrase.strip()})
+        self.phrases = sorted({phrase for phrases in self.metric_phrases.values() for phrase in phrases})
+        self.query_terms = sorted({
+            term for phrase in self.phrases for term in self.tokenize(phrase)
+            if len(term) >= self.MIN_TERM_LENGTH and term not in self.STOP_WORDS
+        })
+
+    @classmethod
+    def from_metrics_file(cls, metrics_path: Union[str, Path]) -> "RelevanceFilter":
+        """
+        Returns a filter for the metrics file, built once per process and file version.
+        """
+        metrics_path = Path(metrics_path)
+        key = (str(metrics_path.resolve()), metrics_path.stat().st_mtime)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                metrics = json.loads(metrics_path.read_text(encoding=cls.STANDARD_ENCODING))
+                cls._instances[key] = cls(metrics)
+            return cls._instances[key]
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls._WORD_RE.findall(text.lower())
+
+    def score_pages(self, page_texts: List[str]) -> List[float]:
+        """
+        BM25 score of each page against the metric terms, with the pages as corpus.
+        """
+        page_terms = [Counter(self.tokenize(text)) for text in page_texts]
+        num_pages = len(page_texts)
+        if num_pages == 0:
+            return []
+        avg_length = sum(sum(terms.values()) for terms in page_terms) / num_pages or 1.0
+        document_frequency = {
+            term: sum(1 for terms in page_terms if term in terms) for term in self.query_terms
+        }
+
+        scores = []
+        for text, terms in zip(page_texts, page_terms):
+            length = sum(terms.values())
+            score = 0.0
+            for term in self.query_terms:
+                frequency = terms.get(term, 0)
+                if not frequency:
+                    continue
+                df = document_frequency[term]
+                idf = math.log(1 + (num_pages - df + 0.5) / (df + 0.5))
+                score += idf * frequency * (self.BM25_K1 + 1) / (
+                    frequency + self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * length / avg_length)
+                )
+            lower = text.lower()
+            score += self.PHRASE_BONUS * sum(lower.count(phrase) for phrase in self.phrases)
+            scores.append(score)
+        return scores
+
+    def metric_page_index(self, page_texts: List[str], max_pages_per_metric: int) -> Dict[str, List[int]]:
+        """
+        Inverted index from each metric to the pages where its name or one of its
+        alternative names occurs, at most max_pages_per_metric pages with the most hits.
+        """
+        lowered = [text.lower() for text in page_texts]
+        index = {}
+        for name, phrases in self.metric_phrases.items():
+            hits = []
+            for page_index, text in enumerate(lowered):
+                count = sum(text.count(phrase) for phrase in phrases)
+                if count:
+                    hits.append((count, page_index))
+            best = sorted(hits, key=lambda hit: (-hit[0], hit[1]))[:max_pages_per_metric]
+            index[name] = sorted(page_index for _, page_index in best)
+        return index
+
+    def select_pages(self, page_texts: List[str], threshold_rate: float, num_neighbours: int = 1) -> List[int]:
+        """
+        Returns indices of pages scoring at least threshold_rate of the best page,
+        together with num_neighbours pages on each side of them.
+        """
+        scores = self.score_pages(page_texts)
+        if not scores or max(scores) <= 0:
+            return list(range(len(page_texts)))
+        threshold = max(scores) * threshold_rate
+        selected = set()
+        for index, score in enumerate(scores):
+            if score >= threshold and score > 0:
+                first = max(0, index - num_neighbours)
+                last = min(len(page_texts) - 1, index + num_neighbours)
+                selected.update(range(first, last + 1))
+        return sorted(selected)
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    On-disk cache of GPT responses in a SQLite database.
+
+    Entries are keyed on a hash of model, temperature, system prompt and request
+    text, so a hit can be returned without calling the API. When the stored
+    responses exceed max_size_bytes the least recently used entries are evicted.
+    """
+    DB_NAME = "responses.db"
+    DEFAULT_MAX_SIZE_BYTES = 256 * 1024 * 1024
+    STANDARD_ENCODING = "utf-8"
+
+    def __init__(self, cache_dir: Union[str, Path], max_size_bytes: int = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.cache_dir / self.DB_NAME
+        self.max_size_bytes = max_size_bytes if max_size_bytes else self.DEFAULT_MAX_SIZE_BYTES
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(model: str, temperature: float, system_prompt: str, request_text: str, response_format: dict = None) -> str:
+        parts = [model, temperature, system_prompt, request_text]
+        if response_format:
+            parts.append(response_format)
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode(ResponseCache.STANDARD_ENCODING)).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, response: str):
+        size = len(response.encode(self.STANDARD_ENCODING))
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time())
+            )
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        num_evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            if total_size <= self.max_size_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+            num_evicted += 1
+        logger.debug(f"Evicted {num_evicted} cached response(s) from {self.db_path}")
+
+    def clear(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses")
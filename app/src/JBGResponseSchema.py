@@ -0,0 +1,215 @@
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from app.src.JBGIncrementalJSONParser import IncrementalJSONParser
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseSchema:
+    """
+    JSON schema for the GPT answer, generated from the metrics definitions.
+
+    Structured outputs in strict mode do not allow free object keys, so the funds and
+    years are sent as arrays of objects with the name and year as fields, while every
+    metric is a fixed (nullable) property. Parsed answers are converted back to the
+    fund -> year -> metric structure used by the rest of the analysis.
+    """
+    METRIC_KEY_NUMBER_KEY = "Nyckeltal"
+    FIELD_VALUE = "värde"
+    FIELD_SOURCE = "källa"
+    FIELD_CERTAINTY = "säkerhet"
+    FIELD_COMMENT = "kommentar"
+    FUNDS_KEY = "a-kassor"
+    FUND_NAME_KEY = "a-kassa"
+    YEARS_KEY = "år"
+    YEAR_KEY = "årtal"
+    METRICS_KEY = "nyckeltal"
+    SCHEMA_NAME = "nyckeltal"
+
+    # Path lengths of fund names, years and metric values in a parsed answer
+    FUND_NAME_DEPTH = 3
+    YEAR_DEPTH = 5
+    METRIC_DEPTH = 6
+
+    def __init__(self, metrics: List[dict]):
+        self.metric_names = [
+            metric.get(self.METRIC_KEY_NUMBER_KEY) for metric in metrics if metric.get(self.METRIC_KEY_NUMBER_KEY)
+        ]
+        self.schema = self._build_schema()
+
+    def _build_schema(self) -> dict:
+        metric_value = {
+            "anyOf": [
+                {
+                    "type": "object",
+                    "properties": {
+                        self.FIELD_VALUE: {"type": ["number", "null"]},
+                        self.FIELD_SOURCE: {"type": "string"},
+                        self.FIELD_CERTAINTY: {"type": "number"},
+                        self.FIELD_COMMENT: {"type": "string"}
+                    },
+                    "required": [self.FIELD_VALUE, self.FIELD_SOURCE, self.FIELD_CERTAINTY, self.FIELD_COMMENT],
+                    "additionalProperties": False
+                },
+                {"type": "null"}
+            ]
+        }
+        year = {
+            "type": "object",
+            "properties": {
+                self.YEAR_KEY: {"type": "string", "description": "Räkenskapsåret, t.ex. \"2023\""},
+                self.METRICS_KEY: {
+                    "type": "object",
+                    "properties": {name: metric_value for name in self.metric_names},
+                    "required": list(self.metric_names),
+                    "additionalProperties": False
+                }
+            },
+            "required": [self.YEAR_KEY, self.METRICS_KEY],
+            "additionalProperties": False
+        }
+        fund = {
+            "type": "object",
+            "properties": {
+                self.FUND_NAME_KEY: {"type": "string", "description": "Namnet på a-kassan"},
+                self.YEARS_KEY: {"type": "array", "items": year}
+            },
+            "required": [self.FUND_NAME_KEY, self.YEARS_KEY],
+            "additionalProperties": False
+        }
+        return {
+            "type": "object",
+            "properties": {self.FUNDS_KEY: {"type": "array", "items": fund}},
+            "required": [self.FUNDS_KEY],
+            "additionalProperties": False
+        }
+
+    @property
+    def response_format(self) -> dict:
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": self.SCHEMA_NAME, "strict": True, "schema": self.schema}
+        }
+
+    def validate_metric_value(self, value: Any) -> Optional[dict]:
+        """
+        Returns the metric value if it can be used, None otherwise. A missing value is
+        kept together with its comment, and the certainty is clamped to [0, 1].
+        """
+        if not isinstance(value, dict):
+            return None
+        number = value.get(self.FIELD_VALUE)
+        if number is not None and (isinstance(number, bool) or not isinstance(number, (int, float))):
+            return None
+        certainty = value.get(self.FIELD_CERTAINTY)
+        if isinstance(certainty, (int, float)) and not isinstance(certainty, bool):
+            value[self.FIELD_CERTAINTY] = min(max(certainty, 0.0), 1.0)
+        return value
+
+    def create_parser(self, on_metric: Callable[[str, str, str, dict], None] = None) -> "StructuredResponseParser":
+        return StructuredResponseParser(self, on_metric)
+
+
+class StructuredResponseParser:
+    """
+    Incremental parser of one schema-shaped answer. Metric values are validated as
+    soon as they are complete, and result() can be called at any time to get the
+    metrics received so far in the fund -> year -> metric structure. on_metric is
+    called with (fund, year, metric, value) for every found value whose fund name and
+    year are already known.
+    """
+
+    def __init__(self, schema: ResponseSchema, on_metric: Callable[[str, str, str, dict], None] = None):
+        self.schema = schema
+        self.on_metric = on_metric
+        self._fund_names: Dict[int, str] = {}
+        self._years: Dict[Tuple[int, int], str] = {}
+        self._metrics: Dict[Tuple[int, int], Dict[str, dict]] = {}
+        self.num_metrics = 0
+        self.num_rejected = 0
+        self._parser = IncrementalJSONParser(
+            on_value=self._on_value,
+            emit_depths={schema.FUND_NAME_DEPTH, schema.YEAR_DEPTH, schema.METRIC_DEPTH}
+        )
+
+    @property
+    def complete(self) -> bool:
+        return self._parser.complete
+
+    def feed(self, text: str):
+        self._parser.feed(text)
+
+    def _on_value(self, path: list, value: Any):
+        schema = self.schema
+        if len(path) == schema.FUND_NAME_DEPTH and path[2] == schema.FUND_NAME_KEY:
+            self._fund_names[path[1]] = str(value)
+        elif len(path) == schema.YEAR_DEPTH and path[4] == schema.YEAR_KEY:
+            self._years[(path[1], path[3])] = str(value)
+        elif len(path) == schema.METRIC_DEPTH and path[4] == schema.METRICS_KEY:
+            if value is None:
+                return
+            metric_value = schema.validate_metric_value(value)
+            if metric_value is None:
+                self.num_rejected += 1
+                logger.debug(f"Rejected value for {path[5]}: {value}")
+                return
+            self._metrics.setdefault((path[1], path[3]), {})[path[5]] = metric_value
+            if metric_value.get(schema.FIELD_VALUE) is not None:
+                self.num_metrics += 1
+                fund_name = self._fund_names.get(path[1])
+                year = self._years.get((path[1], path[3]))
+                if self.on_metric and fund_name and year:
+                    self.on_metric(fund_name, year, path[5], metric_value)
+
+    def result(self) -> dict:
+        result = {}
+        for (fund_index, year_index), metrics in self._metrics.items():
+            fund_name = self._fund_names.get(fund_index)
+            year = self._years.get((fund_index, year_index))
+            if not fund_name or not year:
+                continue
+            result.setdefault(fund_name, {}).setdefault(year, {}).update(metrics)
+        return result
+
+
+class FreeformResponseParser:
+    """
+    Incremental parser of a free-text JSON answer in the fund -> year -> metric
+    structure, used when no response schema is sent. Text before the first brace
+    (e.g. a ```json fence) is skipped.
+    """
+    METRIC_DEPTH = 3
+
+    def __init__(self, on_metric: Callable[[str, str, str, dict], None] = None):
+        self.on_metric = on_metric
+        self._metrics: Dict[str, Dict[str, Dict[str, dict]]] = {}
+        self._started = False
+        self.num_metrics = 0
+        self.num_rejected = 0
+        self._parser = IncrementalJSONParser(on_value=self._on_value, emit_depths={self.METRIC_DEPTH})
+
+    @property
+    def complete(self) -> bool:
+        return self._parser.complete
+
+    def feed(self, text: str):
+        if not self._started:
+            start = text.find("{")
+            if start < 0:
+                return
+            text = text[start:]
+            self._started = True
+        self._parser.feed(text)
+
+    def _on_value(self, path: list, value: Any):
+        if not isinstance(value, dict):
+            return
+        fund_name, year, metric_name = (str(element) for element in path)
+        self._metrics.setdefault(fund_name, {}).setdefault(year, {})[metric_name] = value
+        if value.get(ResponseSchema.FIELD_VALUE) is not None:
+            self.num_metrics += 1
+            if self.on_metric:
+                self.on_metric(fund_name, year, metric_name, value)
+
+    def result(self) -> dict:
+        return self._metrics
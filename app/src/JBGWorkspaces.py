@@ -0,0 +1,98 @@
+import os
+import re
+import shutil
+import time
+import uuid
+import threading
+import logging
+from pathlib import Path
+from typing import Iterable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class WorkspaceManager:
+    """
+    Gives every upload or job its own directory below a common root.
+
+    Workspaces are named by random ids, so requests never share files and several
+    server processes can use the same root. Workspaces that have not been modified
+    for ttl_seconds are removed by gc(), which create() runs at most once per
+    GC_INTERVAL.
+    """
+    DEFAULT_TTL_SECONDS = 24 * 60 * 60
+    GC_INTERVAL = 10 * 60
+    _ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, root: Union[str, Path], ttl_seconds: float = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds if ttl_seconds else self.DEFAULT_TTL_SECONDS
+        self._last_gc = 0.0
+        self._lock = threading.Lock()
+
+    def create(self, workspace_id: str = None, keep: Iterable[str] = ()) -> tuple[str, Path]:
+        self.maybe_gc(keep)
+        workspace_id = workspace_id if workspace_id else uuid.uuid4().hex
+        path = self.path_for(workspace_id)
+        path.mkdir(parents=True, exist_ok=False)
+        return workspace_id, path
+
+    def path_for(self, workspace_id: str) -> Path:
+        if not self._ID_RE.match(workspace_id or ""):
+            raise ValueError(f"Invalid workspace id: {workspace_id}")
+        return self.root / workspace_id
+
+    def resolve_file(self, workspace_id: str, filename: str) -> Optional[Path]:
+        """
+        Returns the file in the workspace, or None if it does not exist or the name
+        points outside the workspace.
+        """
+        try:
+            workspace = self.path_for(workspace_id).resolve()
+        except ValueError:
+            return None
+        file_path = (workspace / filename).resolve()
+        if file_path.parent != workspace or not file_path.is_file():
+            return None
+        return file_path
+
+    @staticmethod
+    def _last_modified(path: Path) -> float:
+        latest = path.stat().st_mtime
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                try:
+                    latest = max(latest, os.stat(os.path.join(dirpath, name)).st_mtime)
+                except OSError:
+                    pass
+        return latest
+
+    def maybe_gc(self, keep: Iterable[str] = ()):
+        with self._lock:
+            if time.monotonic() - self._last_gc < self.GC_INTERVAL:
+                return
+            self._last_gc = time.monotonic()
+        self.gc(keep)
+
+    def gc(self, keep: Iterable[str] = ()) -> int:
+        """
+        Removes expired workspaces, except those listed in keep. Returns the number removed.
+        """
+        keep = set(keep)
+        cutoff = time.time() - self.ttl_seconds
+        removed = 0
+        for path in self.root.iterdir():
+            if not path.is_dir() or not self._ID_RE.match(path.name) or path.name in keep:
+                continue
+            try:
+                if self._last_modified(path) >= cutoff:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+            logger.debug(f"Removed expired workspace {path.name}")
+        if removed:
+            logger.info(f"Removed {removed} expired workspace(s)")
+        return removed
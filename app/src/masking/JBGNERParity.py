@@ -0,0 +1,130 @@
+import sys
+import json
+import time
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+from app.src.masking.JBGNERRegistry import NERRegistry, NER_MODEL, NER_BACKENDS, NER_BACKEND_TORCH
+from app.src.masking.JBGPDFMasking import PDFMasker
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_PATH = Path(__file__).parent / "json" / "ner_parity_fixtures.json"
+# Tolerans: personnamn är de enda entiteter som maskeras och måste stämma exakt, avvikelser
+# i övriga grupper rapporteras bara som varningar
+EXACT_ENTITY_GROUPS = ("PER",)
+
+
+def load_fixtures(path: Path = FIXTURES_PATH) -> List[dict]:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def _normalize_word(word: str) -> str:
+    # Pipelinen kan sätta mellanslag kring bindestreck i sammansatta namn, som "Eva - Lena"
+    return PDFMasker._normalize_hyphens(" ".join(word.split()))
+
+
+def detect_entities(texts: List[str], backend: str, model_name: str = NER_MODEL) -> Tuple[List[Dict[str, Set[str]]], float]:
+    """
+    Runs the NER pipeline of the backend on the texts the same way PDFMasker does, and
+    returns the words found in each text per entity group and the inference time.
+    """
+    pipe = NERRegistry.get(model_name, backend)
+    start = time.perf_counter()
+    with NERRegistry.inference_context(model_name, backend):
+        results = pipe(texts, batch_size=PDFMasker.NER_BATCH_SIZE, stride=PDFMasker.NER_STRIDE)
+    elapsed = time.perf_counter() - start
+    entities = []
+    for text_results in results:
+        groups = {}
+        for r in text_results:
+            groups.setdefault(r["entity_group"], set()).add(_normalize_word(r["word"]))
+        entities.append(groups)
+    return entities, elapsed
+
+
+def record_reference(path: Path = FIXTURES_PATH, backend: str = NER_BACKEND_TORCH, model_name: str = NER_MODEL):
+    """
+    Replaces the recorded entities in the fixture file with those the backend finds.
+    Used with the torch backend to refresh the reference after a model change.
+    """
+    fixtures = load_fixtures(path)
+    entities, _ = detect_entities([fixture["text"] for fixture in fixtures], backend, model_name)
+    for fixture, groups in zip(fixtures, entities):
+        # Every exact group is recorded, also when empty, so that a text without names stays checked
+        for group in EXACT_ENTITY_GROUPS:
+            groups.setdefault(group, set())
+        fixture["entities"] = {group: sorted(words) for group, words in sorted(groups.items())}
+    Path(path).write_text(json.dumps(fixtures, ensure_ascii=False, indent=4) + "\n", encoding="utf-8")
+    logger.info(f"Recorded {backend} entities for {len(fixtures)} fixtures in {path}")
+
+
+def check_parity(backend: str, path: Path = FIXTURES_PATH, model_name: str = NER_MODEL) -> Dict[str, object]:
+    """
+    Compares the entities the backend finds in the fixture texts with the entities
+    recorded in the fixture file. Only the groups recorded for a fixture are compared.
+    The check fails if a group in EXACT_ENTITY_GROUPS differs in any fixture; other
+    differences are returned as mismatches without failing it.
+    """
+    fixtures = load_fixtures(path)
+    unrecorded = [i for i, fixture in enumerate(fixtures) if "entities" not in fixture]
+    if unrecorded:
+        raise ValueError(
+            f"Fixtures {unrecorded} in {path} have no recorded entities, record them with --record --backend torch first"
+        )
+    candidate, candidate_time = detect_entities([fixture["text"] for fixture in fixtures], backend, model_name)
+
+    mismatches = []
+    for i, (fixture, found) in enumerate(zip(fixtures, candidate)):
+        for group, words in sorted(fixture["entities"].items()):
+            expected = set(words)
+            found_words = found.get(group, set())
+            if expected == found_words:
+                continue
+            mismatches.append({
+                "fixture": i,
+                "group": group,
+                "missing": sorted(expected - found_words),
+                "extra": sorted(found_words - expected),
+                "masking_affected": group in EXACT_ENTITY_GROUPS
+            })
+    return {
+        "backend": backend,
+        "fixtures": len(fixtures),
+        "passed": not any(mismatch["masking_affected"] for mismatch in mismatches),
+        "mismatches": mismatches,
+        "seconds": candidate_time
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(
+        description="Jämför NER-backendens entiteter med de inspelade referensentiteterna.",
+        epilog="Spela först in referensen med --record --backend torch för den modell som används."
+    )
+    parser.add_argument("--backend", choices=NER_BACKENDS, required=True)
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES_PATH)
+    parser.add_argument("--model", default=NER_MODEL)
+    parser.add_argument("--record", action="store_true", help="Ersätt referensentiteterna i fixturfilen med backendens (använd torch).")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_reference(args.fixtures, args.backend, args.model)
+        return 0
+
+    report = check_parity(args.backend, args.fixtures, model_name=args.model)
+    for mismatch in report["mismatches"]:
+        level = logging.ERROR if mismatch["masking_affected"] else logging.WARNING
+        logger.log(
+            level,
+            f"Fixtur {mismatch['fixture']} ({mismatch['group']}): saknas {mismatch['missing']}, extra {mismatch['extra']}"
+        )
+    status = "OK" if report["passed"] else "AVVIKER"
+    logger.info(f"{args.backend}: {status} på {report['fixtures']} fixturer, {report['seconds']:.2f} s")
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
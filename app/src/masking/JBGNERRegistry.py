@@ -0,0 +1,209 @@
+import gc
+import os
+import re
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+NER_MODEL = "KBLab/bert-base-swedish-cased-ner"
+NER_MAX_LENGTH = 512
+NER_MAX_THREADS = int(os.environ.get("JBG_NER_THREADS", min(4, os.cpu_count() or 1)))
+
+# Inferensbackend för NER-modellen. onnx-varianterna kräver optimum[onnxruntime]
+NER_BACKEND_TORCH = "torch"
+NER_BACKEND_TORCH_INT8 = "torch-int8"
+NER_BACKEND_ONNX = "onnx"
+NER_BACKEND_ONNX_INT8 = "onnx-int8"
+NER_BACKENDS = (NER_BACKEND_TORCH, NER_BACKEND_TORCH_INT8, NER_BACKEND_ONNX, NER_BACKEND_ONNX_INT8)
+NER_BACKEND = os.environ.get("JBG_NER_BACKEND", NER_BACKEND_TORCH)
+NER_ONNX_DIR = Path(os.environ.get("JBG_NER_ONNX_DIR", Path(tempfile.gettempdir()) / "jbg_ner_onnx"))
+
+
+class NERRegistry:
+    """
+    Process-wide registry of loaded NER pipelines.
+
+    A pipeline is loaded the first time it is asked for and then shared by every
+    PDFMasker in the process. Pipelines are keyed by model and backend, and loading
+    is guarded per key, so concurrent callers wait for one load instead of each
+    loading their own copy. A loaded pipeline is not safe to call from several
+    threads at once, so inference_context serializes the calls into each pipeline.
+
+    Backends:
+        torch       the model as published, run by PyTorch
+        torch-int8  the same model with its linear layers dynamically quantized to int8
+        onnx        the model exported to ONNX and run by ONNX Runtime
+        onnx-int8   the ONNX export with int8 dynamically quantized weights
+
+    The ONNX exports are written to NER_ONNX_DIR and reused by later loads. Use
+    JBGNERParity to check that a backend finds the same entities as torch.
+    """
+    _pipelines: Dict[Tuple[str, str], object] = {}
+    _load_locks: Dict[Tuple[str, str], threading.Lock] = {}
+    _inference_locks: Dict[Tuple[str, str], threading.Lock] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_name: str, backend: str = None) -> Tuple[str, str]:
+        backend = backend if backend else NER_BACKEND
+        if backend not in NER_BACKENDS:
+            raise ValueError(f"Unknown NER backend {backend}, expected one of {NER_BACKENDS}")
+        return model_name, backend
+
+    @classmethod
+    def _load_lock(cls, key: Tuple[str, str]) -> threading.Lock:
+        with cls._lock:
+            return cls._load_locks.setdefault(key, threading.Lock())
+
+    @classmethod
+    def _inference_lock(cls, key: Tuple[str, str]) -> threading.Lock:
+        with cls._lock:
+            return cls._inference_locks.setdefault(key, threading.Lock())
+
+    @classmethod
+    def get(cls, model_name: str = NER_MODEL, backend: str = None):
+        key = cls._key(model_name, backend)
+        pipe = cls._pipelines.get(key)
+        if pipe is not None:
+            return pipe
+        with cls._load_lock(key):
+            pipe = cls._pipelines.get(key)
+            if pipe is None:
+                pipe = cls._load(*key)
+                cls._pipelines[key] = pipe
+        return pipe
+
+    @staticmethod
+    def _load(model_name: str, backend: str = NER_BACKEND_TORCH):
+        from transformers import pipeline
+        NERRegistry._limit_threads()
+        logger.info(f"Loading NER model {model_name} ({backend})")
+        if backend in (NER_BACKEND_ONNX, NER_BACKEND_ONNX_INT8):
+            model = NERRegistry._load_onnx_model(model_name, quantize=backend == NER_BACKEND_ONNX_INT8)
+        else:
+            from transformers import AutoModelForTokenClassification
+            model = AutoModelForTokenClassification.from_pretrained(model_name)
+            if backend == NER_BACKEND_TORCH_INT8:
+                import torch
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        pipe = pipeline("ner", model=model, tokenizer=model_name, aggregation_strategy="simple")
+        # Some tokenizer configs lack a real max length, which the strided windows depend on
+        max_positions = getattr(pipe.model.config, "max_position_embeddings", NER_MAX_LENGTH)
+        if not pipe.tokenizer.model_max_length or pipe.tokenizer.model_max_length > max_positions:
+            pipe.tokenizer.model_max_length = min(max_positions, NER_MAX_LENGTH)
+        return pipe
+
+    @staticmethod
+    def _load_onnx_model(model_name: str, quantize: bool = False):
+        """
+        Loads the ONNX export of the model, exporting (and quantizing) it on first use.
+        """
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForTokenClassification, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError as e:
+            raise ImportError(
+                "The onnx NER backends need optimum with ONNX Runtime: pip install -r requirements-onnx.txt"
+            ) from e
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = NER_MAX_THREADS
+        export_dir = NER_ONNX_DIR / re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        if not (export_dir / "model.onnx").exists():
+            logger.info(f"Exporting NER model {model_name} to ONNX in {export_dir}")
+            model = ORTModelForTokenClassification.from_pretrained(model_name, export=True)
+            model.save_pretrained(export_dir)
+        if not quantize:
+            return ORTModelForTokenClassification.from_pretrained(export_dir, session_options=session_options)
+
+        quantized_dir = export_dir / "int8"
+        if not (quantized_dir / "model_quantized.onnx").exists():
+            logger.info(f"Quantizing ONNX NER model {model_name} to int8")
+            quantizer = ORTQuantizer.from_pretrained(export_dir)
+            config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=quantized_dir, quantization_config=config)
+            (quantized_dir / "config.json").write_bytes((export_dir / "config.json").read_bytes())
+        return ORTModelForTokenClassification.from_pretrained(
+            quantized_dir, file_name="model_quantized.onnx", session_options=session_options
+        )
+
+    @staticmethod
+    def _limit_threads():
+        """
+        Bounds torch's intra-op threads, so parallel jobs do not oversubscribe the cores.
+        """
+        try:
+            import torch
+            if torch.get_num_threads() > NER_MAX_THREADS:
+                torch.set_num_threads(NER_MAX_THREADS)
+        except ImportError:
+            pass
+
+    @staticmethod
+    def _no_grad():
+        try:
+            import torch
+            return torch.inference_mode()
+        except ImportError:
+            return nullcontext()
+
+    @classmethod
+    @contextmanager
+    def inference_context(cls, model_name: str = NER_MODEL, backend: str = None):
+        """
+        Holds the pipeline's inference lock and disables autograd while calling it.
+        """
+        with cls._inference_lock(cls._key(model_name, backend)), cls._no_grad():
+            yield
+
+    @classmethod
+    def is_loaded(cls, model_name: str = NER_MODEL, backend: str = None) -> bool:
+        return cls._key(model_name, backend) in cls._pipelines
+
+    @classmethod
+    def warm(cls, model_name: str = NER_MODEL, background: bool = True, backend: str = None):
+        """
+        Loads the model ahead of the first masking, by default in a background thread.
+        """
+        def load():
+            try:
+                cls.get(model_name, backend)
+            except Exception as e:
+                logger.warning(f"Could not warm NER model {model_name}: {e}")
+
+        if not background:
+            load()
+            return None
+        thread = threading.Thread(target=load, name="ner-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def unload(cls, model_name: str = None, backend: str = None):
+        """
+        Drops one loaded model, or all of them, so the memory can be reclaimed. Without
+        a backend every loaded backend of the model is dropped. Maskers that are running
+        keep their reference until they finish.
+        """
+        with cls._lock:
+            keys = [
+                key for key in cls._pipelines
+                if (not model_name or key[0] == model_name) and (not backend or key[1] == backend)
+            ]
+        for key in keys:
+            with cls._load_lock(key):
+                if cls._pipelines.pop(key, None) is not None:
+                    logger.info(f"Unloaded NER model {key[0]} ({key[1]})")
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
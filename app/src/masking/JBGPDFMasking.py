@@ -1,14 +1,88 @@
 import fitz  # PyMuPDF
+import os
 import re
-from transformers import pipeline
 import sys
+import shutil
+import logging
+import threading
+import multiprocessing
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from logging import Logger
+from typing import List, Tuple
 import tempfile
+from app.src.JBGPDFDocument import PDFDocument
+from app.src.JBGAnnualReportExceptions import MaskingException
+from app.src.masking import JBGNERRegistry
+from app.src.masking.JBGNERRegistry import NERRegistry, NER_MODEL
+from app.src.masking.JBGTermRedactor import TermRedactor
+
+logger = logging.getLogger(__name__)
+
+# Antal arbetsprocesser för maskering av stora dokument; 1 maskerar i den egna processen
+MASKING_WORKERS = int(os.environ.get("JBG_MASKING_WORKERS", 1))
 
 class PDFMasker:
-    def __init__(self):
-        self.ner = pipeline("ner", model="KBLab/bert-base-swedish-cased-ner", tokenizer="KBLab/bert-base-swedish-cased-ner", aggregation_strategy="simple")
+    """
+    Maskerar personuppgifter i PDF-filer. Stora dokument maskeras i en pool av arbetsprocesser
+    som startas första gången den behövs och återanvänds för följande dokument, så att varje
+    process bara laddar NER-modellen en gång. Poolen stängs med close() eller som kontexthanterare.
+    """
+    NER_BATCH_SIZE = 8
+    NER_STRIDE = 64
+    # Varje arbetsprocess laddar en egen NER-modell, så små dokument delas inte upp
+    MIN_PAGES_PER_WORKER = 20
+
+    def __init__(
+        self,
+        model_name: str = NER_MODEL,
+        batch_size: int = None,
+        stride: int = None,
+        backend: str = None,
+        workers: int = None
+    ):
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size if batch_size else self.NER_BATCH_SIZE
+        self.stride = stride if stride else self.NER_STRIDE
+        self.workers = max(1, workers if workers else MASKING_WORKERS)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    def _pool_size(self) -> int:
+        return min(self.workers, os.cpu_count() or 1)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                pool_size = self._pool_size()
+                threads = max(1, (os.cpu_count() or 1) // pool_size)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=pool_size,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_masking_worker,
+                    initargs=(threads, self.model_name, self.backend)
+                )
+            return self._pool
+
+    @property
+    def ner(self):
+        # Modellen laddas en gång per process och delas av alla maskerare
+        return NERRegistry.get(self.model_name, self.backend)
 
     def sanitize_pdf(self, input_pdf: Path, logger: Logger = None) -> Path:
         temp_dir = tempfile.mkdtemp()
@@ -25,8 +99,7 @@ class PDFMasker:
             return input_pdf
 
     def extract_text(self, pdf_path):
-        doc = fitz.open(pdf_path)
-        return [page.get_text() for page in doc]
+        return PDFDocument.load_page_texts(pdf_path)
 
     def _clean_entities(self, entities):
         cleaned = []
@@ -43,17 +116,51 @@ class PDFMasker:
             cleaned.append(updated_word)
         return cleaned
 
-    def detect_sensitive_terms(self, page_texts, max_chunk_chars=512):
-        sensitive_words = set()
-        for text in page_texts:
+    def _detect_person_names(self, page_texts):
+        """
+        Kör NER på hela sidor i batchar. Pipelinen delar upp varje sida i fönster av modellens
+        maxlängd som överlappar med stride tokens, så att namn i fönsterkanterna inte delas.
+        Misslyckas batchkörningen körs texten i mindre bitar, se _detect_person_names_sliced.
+        """
+        texts = [text for text in page_texts if text.strip()]
+        if not texts:
+            return set()
+        try:
+            with NERRegistry.inference_context(self.model_name, self.backend):
+                results = self.ner(texts, batch_size=self.batch_size, stride=self.stride)
+        except Exception as e:
+            logger.warning(
+                f"NER i batchar misslyckades för {len(texts)} texter, kör i mindre bitar: {type(e).__name__}: {e}",
+                exc_info=True
+            )
+            return self._detect_person_names_sliced(texts)
+        names = set()
+        for page_results in results:
+            names.update(r['word'].strip() for r in page_results if r['entity_group'] == 'PER')
+        return names
+
+    def _detect_person_names_sliced(self, page_texts, max_chunk_chars=512):
+        """
+        Kör NER bit för bit. En bit som inte kan köras skulle lämna namn omaskerade, så då
+        avbryts maskeringen med MaskingException i stället för att biten hoppas över.
+        """
+        names = set()
+        for page_index, text in enumerate(page_texts):
             for i in range(0, len(text), max_chunk_chars):
                 chunk = text[i:i + max_chunk_chars]
                 try:
-                    ner_results = self.ner(chunk)
-                    names = {r['word'].strip() for r in ner_results if r['entity_group'] == 'PER'}
-                    sensitive_words.update(names)
+                    with NERRegistry.inference_context(self.model_name, self.backend):
+                        ner_results = self.ner(chunk)
                 except Exception as e:
-                    print(f"NER-fel: {e}")
+                    raise MaskingException(f"NER misslyckades för text {page_index + 1}, tecken {i}: {e}") from e
+                names.update(r['word'].strip() for r in ner_results if r['entity_group'] == 'PER')
+        return names
+
+    def detect_sensitive_terms(self, page_texts):
+        return self._clean_entities(self._find_sensitive_terms(page_texts))
+
+    def _find_sensitive_terms(self, page_texts) -> set:
+        sensitive_words = self._detect_person_names(page_texts)
         full_text = "\n".join(page_texts)
         pnr_matches = set(re.findall(r"\b\d{6}[-+]\d{4}\b", full_text))
         full_text = self._fix_split_emails(full_text)
@@ -61,8 +168,7 @@ class PDFMasker:
         twitter_matches = set(re.findall(r"@[A-Za-z0-9_]{1,15}", full_text))
         dob_matches = set(re.findall(r"\bDOB:\s*(?:19|20)\d{2}/\d{2}/\d{2}\b", full_text))
         extra_fornamn, extra_efternamn = self._get_extra_names()
-        all_terms = sensitive_words.union(pnr_matches, email_matches, twitter_matches, dob_matches, extra_fornamn, extra_efternamn)
-        return self._clean_entities(all_terms)
+        return sensitive_words.union(pnr_matches, email_matches, twitter_matches, dob_matches, extra_fornamn, extra_efternamn)
 
     @staticmethod
     def _fix_split_emails(text: str) -> str:
@@ -99,13 +205,7 @@ class PDFMasker:
     def mask_pdf_black_boxes(self, input_pdf: Path, output_pdf: Path, sensitive_terms, logger: Logger = None):
         try:
             doc = fitz.open(input_pdf)
-            for page in doc:
-                for term in sensitive_terms:
-                    quads = page.search_for(term, quads=True)
-                    for quad in quads:
-                        rect = self._make_masking_rectangle(quad)
-                        page.add_redact_annot(rect, fill=(0, 0, 0))
-                page.apply_redactions()
+            self._redact_pages(doc, sensitive_terms)
             doc.save(output_pdf, garbage=4, deflate=True, clean=True)
             if logger: logger.info(f"Masked file saved: {output_pdf}")
             return output_pdf
@@ -119,6 +219,99 @@ class PDFMasker:
                     pass
             return None
 
+    def _redact_pages(self, doc, sensitive_terms):
+        # Alla termer matchas i en passage per sida i stället för en sökning per term
+        redactor = TermRedactor(sensitive_terms)
+        for page in doc:
+            for quad in redactor.page_quads(page):
+                rect = self._make_masking_rectangle(quad)
+                page.add_redact_annot(rect, fill=(0, 0, 0))
+            page.apply_redactions()
+
+    def _page_ranges(self, page_count: int) -> List[Tuple[int, int]]:
+        num_ranges = min(self._pool_size(), page_count // self.MIN_PAGES_PER_WORKER)
+        if num_ranges <= 1:
+            return [(0, page_count)]
+        size = -(-page_count // num_ranges)
+        return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+    def mask_pdf_in_parallel(self, input_pdf: Path, output_pdf: Path, page_ranges: List[Tuple[int, int]], logger: Logger = None):
+        """
+        Maskerar sidintervallen i maskerarens processpool. Varje process extraherar text och kör NER
+        på sitt intervall, termerna slås ihop och varje process maskerar sedan sitt intervall med
+        alla termer. Delarna sätts till sist ihop till ett dokument.
+        """
+        executor = self._get_pool()
+        part_dir = Path(tempfile.mkdtemp())
+        try:
+            try:
+                futures = [
+                    executor.submit(
+                        _find_terms_in_pages, str(input_pdf), start, stop,
+                        self.model_name, self.backend, self.batch_size, self.stride
+                    )
+                    for start, stop in page_ranges
+                ]
+                sensitive_terms = self._clean_entities(set().union(*(future.result() for future in futures)))
+                if logger:
+                    logger.info(f"Identified sensitive terms: {sensitive_terms}")
+                futures = [
+                    executor.submit(_redact_page_range, str(input_pdf), start, stop, sensitive_terms, str(part_dir / f"part_{i}.pdf"))
+                    for i, (start, stop) in enumerate(page_ranges)
+                ]
+                part_paths = [future.result() for future in futures]
+            except BrokenProcessPool:
+                # En trasig pool kan inte användas igen, så nästa dokument får en ny
+                self.close()
+                raise
+            self._stitch_parts(input_pdf, part_paths, output_pdf, logger)
+            if logger: logger.info(f"Masked file saved: {output_pdf}")
+            return output_pdf
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+    @staticmethod
+    def _stitch_parts(source_pdf: Path, part_paths: List[str], output_pdf: Path, logger: Logger = None):
+        """
+        Sätter ihop delarna till ett dokument. Länkar inom en del följer med sidorna, medan
+        interna länkar mellan sidor i olika delar försvinner när delen väljs ut och därför
+        återskapas från källan.
+        """
+        source = fitz.open(source_pdf)
+        doc = fitz.open()
+        try:
+            part_starts = []
+            for part_path in part_paths:
+                part_starts.append(doc.page_count)
+                with fitz.open(part_path) as part:
+                    doc.insert_pdf(part, links=True, annots=True)
+            PDFMasker._restore_cross_part_links(source, doc, part_starts)
+            # Metadata och innehållsförteckning följer inte med sidorna, så de kopieras från källan
+            try:
+                doc.set_metadata(source.metadata)
+                toc = source.get_toc(simple=False)
+                if toc:
+                    doc.set_toc(toc)
+            except Exception as e:
+                if logger:
+                    logger.warning(f"Could not copy metadata or outline to the masked file: {e}")
+            doc.save(output_pdf, garbage=4, deflate=True, clean=True)
+        finally:
+            doc.close()
+            source.close()
+
+    @staticmethod
+    def _restore_cross_part_links(source, doc, part_starts: List[int]):
+        def part_of(page_no: int) -> int:
+            return bisect_right(part_starts, page_no) - 1
+
+        for page_no in range(source.page_count):
+            for link in source[page_no].get_links():
+                target = link.get("page", -1)
+                if link["kind"] != fitz.LINK_GOTO or target < 0 or part_of(target) == part_of(page_no):
+                    continue
+                doc[page_no].insert_link({key: link[key] for key in ("kind", "from", "page", "to", "zoom") if key in link})
+
     def _has_check_pdf(self):
         return hasattr(fitz.Document, "check_pdf")
     
@@ -151,6 +344,17 @@ class PDFMasker:
             return None
 
         try:
+            page_ranges = self._page_ranges(doc.page_count)
+            if len(page_ranges) > 1:
+                if logger:
+                    logger.info(f"Masking {doc.page_count} pages in {len(page_ranges)} worker processes")
+                try:
+                    return self.mask_pdf_in_parallel(sanitized_path, pdf_output_path, page_ranges, logger)
+                # MaskingException ärver inte Exception och hanteras nedan
+                except Exception as e:
+                    if logger:
+                        logger.warning(f"Parallel masking failed, masking in one process: {e}")
+
             page_texts = self.extract_text(sanitized_path)
             sensitive_terms = self.detect_sensitive_terms(page_texts)
             if logger:
@@ -162,6 +366,10 @@ class PDFMasker:
                 if logger:
                     logger.warning(f"Masking failed. No output file created.")
                 return None
+        except MaskingException as ex:
+            if logger:
+                logger.error(f"Masking failed, sensitive terms could not be detected: {ex.message}")
+            return None
         finally:
             # Städa temporär fil
             if sanitized_path != pdf_path and sanitized_path.exists():
@@ -171,9 +379,29 @@ class PDFMasker:
                     pass
 
 
+def _init_masking_worker(threads: int, model_name: str, backend: str):
+    # Processerna delar på kärnorna, så varje NER-modell får bara sin andel av trådarna
+    JBGNERRegistry.NER_MAX_THREADS = min(JBGNERRegistry.NER_MAX_THREADS, threads)
+    # Modellen laddas när processen startar och används sedan för alla dokument
+    NERRegistry.get(model_name, backend)
+
+
+def _find_terms_in_pages(pdf_path: str, start: int, stop: int, model_name: str, backend: str, batch_size: int, stride: int) -> set:
+    with fitz.open(pdf_path) as doc:
+        page_texts = [doc[i].get_text() for i in range(start, stop)]
+    masker = PDFMasker(model_name=model_name, batch_size=batch_size, stride=stride, backend=backend)
+    return masker._find_sensitive_terms(page_texts)
+
+
+def _redact_page_range(pdf_path: str, start: int, stop: int, sensitive_terms, part_path: str) -> str:
+    with fitz.open(pdf_path) as doc:
+        doc.select(list(range(start, stop)))
+        PDFMasker()._redact_pages(doc, sensitive_terms)
+        doc.save(part_path, garbage=4, deflate=True, clean=True)
+    return part_path
+
+
 def main(pdf_path_str):
-    
-    import logging
 
     def get_logger():
         logger = logging.getLogger("PDFMasker")
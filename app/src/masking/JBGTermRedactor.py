@@ -0,0 +1,120 @@
+import re
+from bisect import bisect_right
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Tuple
+import fitz  # PyMuPDF
+
+
+class TermRedactor:
+    """
+    Finds all sensitive terms on a page in one pass.
+
+    The terms are compiled into an Aho–Corasick automaton. Each page's words are
+    extracted once with their coordinates, joined with single spaces and scanned by
+    the automaton, so the time per page depends on the amount of text and not on the
+    number of terms. Like page.search_for, matching ignores case and may start or end
+    inside a word. A match that covers only part of a word gets a rectangle
+    interpolated from the word's box.
+    """
+    _WHITESPACE_RE = re.compile(r"\s+")
+
+    def __init__(self, terms: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._lengths: List[Tuple[int, ...]] = [()]
+        for term in terms:
+            self._add(self.normalize(term))
+        self._build()
+
+    @staticmethod
+    def _normalize_chars(text: str) -> str:
+        """
+        Lower-cases text and turns whitespace into spaces character by character, so
+        positions in the result are the same as in the input.
+        """
+        return "".join(" " if c.isspace() else c.lower() if len(c.lower()) == 1 else c for c in text)
+
+    @classmethod
+    def normalize(cls, term: str) -> str:
+        return cls._normalize_chars(cls._WHITESPACE_RE.sub(" ", term.strip()))
+
+    def _add(self, term: str):
+        if not term:
+            return
+        state = 0
+        for c in term:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][c] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._lengths.append(())
+            state = next_state
+        if len(term) not in self._lengths[state]:
+            self._lengths[state] += (len(term),)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(c, 0)
+                self._fail[next_state] = fail if fail != next_state else 0
+                # Termer som slutar i fail-tillståndet slutar även här
+                self._lengths[next_state] += tuple(
+                    length for length in self._lengths[fail] if length not in self._lengths[next_state]
+                )
+
+    def find(self, text: str) -> Iterator[Tuple[int, int]]:
+        """
+        Yields (start, end) of every occurrence of a term in already normalized text.
+        """
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(c, 0)
+            for length in self._lengths[state]:
+                yield i + 1 - length, i + 1
+
+    def page_quads(self, page: fitz.Page) -> List[fitz.Quad]:
+        """
+        Returns one quad per line segment of every term occurrence on the page.
+        """
+        words = page.get_text("words")
+        if not words or len(self._goto) == 1:
+            return []
+        starts = []
+        offset = 0
+        for word in words:
+            starts.append(offset)
+            offset += len(word[4]) + 1
+        text = self._normalize_chars(" ".join(word[4] for word in words))
+
+        rects = {}
+        for start, end in self.find(text):
+            index = bisect_right(starts, start) - 1
+            current = None
+            while index < len(words) and starts[index] < end:
+                x0, y0, x1, y1, word_text, block, line = words[index][:7]
+                length = max(len(word_text), 1)
+                first = max(start - starts[index], 0)
+                last = min(end - starts[index], length)
+                if last > first:
+                    width = x1 - x0
+                    rect = fitz.Rect(x0 + width * first / length, y0, x0 + width * last / length, y1)
+                    if current and current[0] == (block, line):
+                        current[1].include_rect(rect)
+                    else:
+                        if current:
+                            rects[tuple(current[1])] = current[1]
+                        current = ((block, line), rect)
+                index += 1
+            if current:
+                rects[tuple(current[1])] = current[1]
+        return [rect.quad for rect in rects.values()]
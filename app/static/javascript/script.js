@@ -24,8 +24,68 @@ document.addEventListener("DOMContentLoaded", function () {
             }
         });
     });
+
+    const jobPanel = document.getElementById("job-panel");
+    if (jobPanel) {
+        watchJob(jobPanel);
+    }
 });
 
+const JOB_POLL_INTERVAL_MS = 3000;
+const JOB_STATUS_TEXT = {
+    queued: "Analysen väntar i kön…",
+    running: "Analysen pågår…",
+    done: "Analysen är klar.",
+    failed: "Analysen misslyckades",
+    cancelled: "Analysen avbröts.",
+    interrupted: "Analysen avbröts när tjänsten startades om"
+};
+
+// Pollar jobbets status tills det är klart, misslyckat eller avbrutet
+function watchJob(panel) {
+    const jobId = panel.dataset.jobId;
+    const statusText = document.getElementById("job-status");
+    const download = document.getElementById("job-download");
+    const downloadLink = document.getElementById("job-download-link");
+    const cancelButton = document.getElementById("job-cancel");
+
+    cancelButton.addEventListener("click", function () {
+        cancelButton.disabled = true;
+        fetch(`/jobs/${jobId}/cancel`, { method: "POST" })
+            .then(() => poll())
+            .catch(error => console.warn("Kunde inte avbryta jobbet:", error));
+    });
+
+    function poll() {
+        fetch(`/jobs/${jobId}`)
+            .then(response => {
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                return response.json();
+            })
+            .then(job => {
+                let text = JOB_STATUS_TEXT[job.status] || job.status;
+                if (job.error) text += `: ${job.error}`;
+                statusText.textContent = text;
+
+                if (job.status === "queued" || job.status === "running") {
+                    setTimeout(poll, JOB_POLL_INTERVAL_MS);
+                    return;
+                }
+                cancelButton.hidden = true;
+                if (job.status === "done" && job.result_url) {
+                    downloadLink.href = job.result_url;
+                    download.hidden = false;
+                }
+            })
+            .catch(error => {
+                console.warn("Kunde inte hämta jobbets status:", error);
+                setTimeout(poll, JOB_POLL_INTERVAL_MS);
+            });
+    }
+
+    poll();
+}
+
 function showTab(tabId) {
     console.log("showTab called with tabId:", tabId);
 
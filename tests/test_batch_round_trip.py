@@ -0,0 +1,145 @@
+import io
+import json
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable
+from app.src.JBGAnnualReportAnalysis import JBGAnnualReportAnalyzer
+
+APP_DIR = Path(__file__).resolve().parents[1] / "app"
+
+
+class FakeBatchClient:
+    """
+    In-memory stand-in for the files and batches endpoints of the OpenAI client, as
+    used by BatchRunner.
+
+    Every request in an uploaded JSONL file is answered by respond(body). Requests
+    whose custom_id is in fail_ids end up in the error file, those in error_ids get
+    a 500 response in the output file and those in truncate_ids finish with
+    "length". The output lines are written in reverse order, so a caller that maps
+    results by position instead of by custom_id gets them wrong. A batch reports
+    in_progress for the first polls_until_done - 1 polls.
+    """
+
+    def __init__(
+        self,
+        respond: Callable[[dict], str],
+        fail_ids: Iterable[str] = (),
+        error_ids: Iterable[str] = (),
+        truncate_ids: Iterable[str] = (),
+        polls_until_done: int = 2
+    ):
+        self.respond = respond
+        self.fail_ids = set(fail_ids)
+        self.error_ids = set(error_ids)
+        self.truncate_ids = set(truncate_ids)
+        self.polls_until_done = polls_until_done
+        self.uploaded_requests = []
+        self._files: Dict[str, str] = {}
+        self._batches: Dict[str, dict] = {}
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch, cancel=self._cancel_batch)
+
+    def _create_file(self, file, purpose: str):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self._files[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id: str):
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: dict = None):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        self._batches[batch_id] = {"input_file_id": input_file_id, "polls": 0, "status": "validating", "files": None}
+        return self._retrieve_batch(batch_id, count_poll=False)
+
+    def _cancel_batch(self, batch_id: str):
+        self._batches[batch_id]["status"] = "cancelled"
+
+    def _run_batch(self, batch: dict) -> tuple:
+        output_lines, error_lines = [], []
+        for line in io.StringIO(self._files[batch["input_file_id"]]):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            self.uploaded_requests.append(request)
+            custom_id = request["custom_id"]
+            if custom_id in self.fail_ids:
+                error_lines.append({"custom_id": custom_id, "response": None, "error": {"code": "server_error", "message": "stub"}})
+                continue
+            if custom_id in self.error_ids:
+                output_lines.append({"custom_id": custom_id, "response": {"status_code": 500, "body": {}}, "error": None})
+                continue
+            finish_reason = "length" if custom_id in self.truncate_ids else "stop"
+            body = {"choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": self.respond(request["body"])}}]}
+            output_lines.append({"custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None})
+
+        output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self._files[output_file_id] = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in reversed(output_lines))
+        error_file_id = None
+        if error_lines:
+            error_file_id = f"file-{uuid.uuid4().hex[:12]}"
+            self._files[error_file_id] = "".join(json.dumps(record) + "\n" for record in error_lines)
+        return output_file_id, error_file_id, len(output_lines) + len(error_lines), len(error_lines)
+
+    def _retrieve_batch(self, batch_id: str, count_poll: bool = True):
+        batch = self._batches[batch_id]
+        if count_poll and batch["status"] not in ("completed", "cancelled"):
+            batch["polls"] += 1
+            batch["status"] = "completed" if batch["polls"] >= self.polls_until_done else "in_progress"
+        if batch["status"] == "completed" and batch["files"] is None:
+            batch["files"] = self._run_batch(batch)
+        output_file_id, error_file_id, total, failed = batch["files"] or (None, None, 0, 0)
+        return SimpleNamespace(
+            id=batch_id,
+            status=batch["status"],
+            output_file_id=output_file_id,
+            error_file_id=error_file_id,
+            request_counts=SimpleNamespace(total=total, completed=total - failed, failed=failed)
+        )
+
+
+def test_batch_round_trip(tmp_path):
+    """
+    Runs the batch mode of the analyzer against FakeBatchClient and checks that every
+    answer ends up at its own document and chunk, and that failed, erroneous and
+    truncated requests are left out without affecting the others.
+    """
+    analyzer = JBGAnnualReportAnalyzer(
+        upload_dir=tmp_path,
+        instruction_path=APP_DIR / "prompt" / "GPT-instruktioner_komprimerad.md",
+        metrics_path=APP_DIR / "prompt" / "json" / "nyckeltalsdefinitioner.json",
+        execution_mode=JBGAnnualReportAnalyzer.EXECUTION_MODE_BATCH,
+        openai_api_key="stub"
+    )
+    schema = analyzer.response_schema
+    metric_name = schema.metric_names[0]
+
+    def respond(body: dict) -> str:
+        # The chunk text is "dokument <d> chunk <c>", which the answer echoes back
+        request_text = body["messages"][-1]["content"]
+        doc_index, chunk_index = (int(n) for n in request_text.split("dokument ")[1].split()[::2][:2])
+        metrics = {name: None for name in schema.metric_names}
+        metrics[metric_name] = {schema.FIELD_VALUE: chunk_index, schema.FIELD_SOURCE: "", schema.FIELD_CERTAINTY: 1.0, schema.FIELD_COMMENT: ""}
+        answer = {schema.FUNDS_KEY: [{schema.FUND_NAME_KEY: f"Kassa {doc_index}", schema.YEARS_KEY: [{schema.YEAR_KEY: "2023", schema.METRICS_KEY: metrics}]}]}
+        return json.dumps(answer, ensure_ascii=False)
+
+    num_chunks = 4
+    documents = [
+        (tmp_path / f"doc{d}.pdf", 2023, [f"dokument {d} chunk {c}" for c in range(num_chunks)], ["system"] * num_chunks, [schema] * num_chunks)
+        for d in range(3)
+    ]
+    lost_ids = {"0-1", "1-3", "2-0"}
+    client = FakeBatchClient(respond, fail_ids={"0-1"}, error_ids={"1-3"}, truncate_ids={"2-0"})
+    analyzer.openai_client = client
+    analyzer.BATCH_POLL_INTERVAL = 0.01
+
+    results_per_document = analyzer._analyze_documents_in_batch(documents, model=analyzer.DEFAULT_MODEL)
+
+    assert len(client.uploaded_requests) == len(documents) * num_chunks
+    assert len(results_per_document) == len(documents)
+    for doc_index, partial_results in enumerate(results_per_document):
+        expected = [c for c in range(num_chunks) if f"{doc_index}-{c}" not in lost_ids]
+        found = [result[f"Kassa {doc_index}"]["2023"][metric_name][schema.FIELD_VALUE] for result in partial_results]
+        assert found == expected, f"Dokument {doc_index}"